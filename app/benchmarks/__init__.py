@@ -0,0 +1,7 @@
+"""
+Offline benchmarks, which need no API key:
+
+- query_benchmark: recall and latency of the query engine on a synthetic index
+- index_benchmark: throughput, task latency, memory and no-op re-index time
+  of indexing a synthetic repository against a simulated LLM backend
+"""
@@ -0,0 +1,261 @@
+"""
+Benchmarks indexing offline, on a synthetic repository with a simulated
+LLM backend: the walk of the file system, process_repository and
+create_vector_store, each followed by a re-run with nothing to do.
+Reports files per second, the p50/p99 latency of file and folder tasks
+and of each stage of indexing, the peak RSS after each stage and the
+no-op re-index times.
+
+    python -m app.benchmarks.index_benchmark --files 5000 --latency 0.5 --rate-limit-ratio 0.02
+
+With --baseline, the report is compared with an earlier one and the
+benchmark fails if any stage got slower than --tolerance allows.
+"""
+import argparse
+import dataclasses
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+from .simulated_llm import simulated_llm_factory
+from .synthetic_repo import generate_repo
+from ..cli.commands.index.create_vector_store import create_vector_store
+from ..cli.commands.index.process_repository import process_repository
+from ..cli.utils.metrics import Metrics
+from ..cli.utils.run_journal import RunJournal
+from ..cli.utils.traverse_file_system import traverse_file_system
+from ..data_types import AutodocRepoConfig, ProcessFileParams, TraverseFileSystemParams
+
+# Metrics compared with the baseline, and whether higher is better
+COMPARED_METRICS = {
+    ("traverse", "files_per_second"): True,
+    ("index", "files_per_second"): True,
+    ("index", "noop_seconds"): False,
+    ("vector_store", "files_per_second"): True,
+    ("vector_store", "noop_seconds"): False,
+}
+
+
+def peak_rss_mb() -> float:
+    """
+    ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    if not seconds:
+        return {"p50_ms": 0.0, "p99_ms": 0.0}
+    return {
+        "p50_ms": round(float(np.percentile(seconds, 50)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(seconds, 99)) * 1000, 3),
+    }
+
+
+def benchmark_traverse(config: AutodocRepoConfig) -> Dict[str, Any]:
+    files = 0
+
+    def count_file(params: ProcessFileParams) -> None:
+        nonlocal files
+        files += 1
+
+    start = time.perf_counter()
+    traverse_file_system(TraverseFileSystemParams(
+        input_path=config.root,
+        project_name=config.name,
+        process_file=count_file,
+        process_folder=None,
+        ignore=config.ignore,
+        file_prompt=config.file_prompt,
+        folder_prompt=config.folder_prompt,
+        content_type=config.content_type,
+        target_audience=config.target_audience,
+        link_hosted=config.link_hosted,
+        scan_workers=config.scan_workers,
+    ))
+    seconds = time.perf_counter() - start
+    return {
+        "files": files,
+        "seconds": round(seconds, 3),
+        "files_per_second": round(files / seconds, 1),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def benchmark_index(config: AutodocRepoConfig, args: argparse.Namespace, files: int) -> Dict[str, Any]:
+    create_llm = simulated_llm_factory(
+        latency_seconds=args.latency,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        rate_limit_ratio=args.rate_limit_ratio,
+    )
+
+    metrics = Metrics()
+    start = time.perf_counter()
+    models = process_repository(config, create_llm=create_llm, metrics=metrics)
+    seconds = time.perf_counter() - start
+
+    """
+    The journal keeps how long each file and folder task took
+    """
+    journal = RunJournal(os.path.join(config.output, "journal.sqlite"))
+    entries = journal.entries()
+    journal.close()
+
+    start = time.perf_counter()
+    process_repository(config, create_llm=create_llm)
+    noop_seconds = time.perf_counter() - start
+
+    return {
+        "seconds": round(seconds, 3),
+        "files_per_second": round(files / seconds, 1),
+        "calls": sum(model.calls for model in models),
+        "failed": sum(1 for entry in entries if entry.state == "failed"),
+        "file_tasks": percentiles([entry.seconds for entry in entries if entry.kind == "file"]),
+        "folder_tasks": percentiles([entry.seconds for entry in entries if entry.kind == "folder"]),
+        "stages": {
+            histogram["labels"]["stage"]: {
+                "count": histogram["count"],
+                "p50_ms": round(histogram["p50"] * 1000, 3),
+                "p99_ms": round(histogram["p99"] * 1000, 3),
+            }
+            for histogram in metrics.report()["histograms"] if histogram["name"] == "stage_seconds"
+        },
+        "noop_seconds": round(noop_seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def benchmark_vector_store(config: AutodocRepoConfig, files: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    create_vector_store(config)
+    seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    create_vector_store(config)
+    noop_seconds = time.perf_counter() - start
+
+    return {
+        "seconds": round(seconds, 3),
+        "files_per_second": round(files / seconds, 1),
+        "noop_seconds": round(noop_seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Returns the metrics that are worse than in the baseline by more than tolerance
+    """
+    regressions = []
+    for (stage, metric), higher_is_better in COMPARED_METRICS.items():
+        old = baseline.get(stage, {}).get(metric)
+        new = report.get(stage, {}).get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f"{stage}.{metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def run(args: argparse.Namespace, path: str) -> Dict[str, Any]:
+    random.seed(args.seed)
+    repo = os.path.join(path, "repo")
+    repository = generate_repo(
+        repo,
+        files=args.files,
+        depth=args.depth,
+        folders_per_folder=args.folders_per_folder,
+        file_size=args.file_size,
+        duplicate_ratio=args.duplicate_ratio,
+        seed=args.seed,
+    )
+
+    config = AutodocRepoConfig(
+        name="benchmark",
+        repository_url="https://github.com/example/benchmark",
+        root=repo,
+        output=os.path.join(path, "json"),
+        llms=[args.model],
+        ignore=[],
+        file_prompt="Write a detailed technical explanation of what this code does.",
+        folder_prompt="Write a technical explanation of what the code in this folder does.",
+        chat_prompt="",
+        content_type="code",
+        target_audience="smart developer",
+        link_hosted=False,
+        max_concurrent_calls=args.max_concurrent_calls,
+        concurrency=args.concurrency,
+        embedder="hash",
+    )
+
+    return {
+        "repository": repository,
+        "settings": {
+            "model": args.model,
+            "latency": args.latency,
+            "latency_sigma": args.latency_sigma,
+            "output_tokens": args.output_tokens,
+            "rate_limit_ratio": args.rate_limit_ratio,
+            "concurrency": args.concurrency,
+            "max_concurrent_calls": args.max_concurrent_calls,
+        },
+        "traverse": benchmark_traverse(config),
+        "index": benchmark_index(config, args, repository["files"]),
+        "vector_store": benchmark_vector_store(
+            dataclasses.replace(config, output=os.path.join(path, "data")),
+            repository["files"],
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="index_benchmark")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--folders-per-folder", type=int, default=4)
+    parser.add_argument("--file-size", type=int, default=2000, help="average file size in bytes")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1)
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--latency", type=float, default=0.5, help="median seconds before a response starts")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="sigma of the log-normal latency")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--output-tokens", type=int, default=300, help="average tokens of a response")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of requests failing with a 429")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--max-concurrent-calls", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--path", help="folder for the repository and the index, a temporary one by default")
+    parser.add_argument("--output", help="file to write the report to")
+    parser.add_argument("--baseline", help="report of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        report = run(args, args.path or tmp)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.loads(f.read()), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
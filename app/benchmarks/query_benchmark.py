@@ -0,0 +1,160 @@
+"""
+Benchmarks the query engine on a synthetic index: recall@k against an
+exact search, and the latency of single, batched and filtered queries.
+
+    python -m app.benchmarks.query_benchmark --chunks 1000000
+"""
+import os
+
+# Measure one CPU core, as BLAS would otherwise use every core
+for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(variable, "1")
+
+import argparse
+import json
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain.schema import Document
+from numpy.typing import NDArray
+
+from ..cli.utils.embeddings import HashEmbedder, normalize
+from ..cli.utils.query_engine import QueryEngine
+from ..cli.utils.vector_store import VectorStore, DEFAULT_NPROBE
+
+# Vectors generated and written to the store at a time
+BUILD_BATCH = 50000
+
+# Sources of the synthetic chunks, so filters can keep a share of them
+SOURCES = 1000
+
+
+def synthetic_vectors(
+        rng: np.random.Generator,
+        centers: NDArray[np.float32],
+        count: int,
+        noise: float = 0.6,
+) -> NDArray[np.float32]:
+    """
+    Unit vectors scattered around random centers, as embeddings
+    of documents on a number of topics are
+    """
+    offsets = normalize(rng.standard_normal((count, centers.shape[1])).astype(np.float32))
+    return normalize(centers[rng.integers(0, len(centers), count)] + noise * offsets)
+
+
+def build(path: str, chunks: int, dimension: int, seed: int) -> NDArray[np.float32]:
+    """
+    Writes a synthetic index to path and returns the centers of its topics
+    """
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.standard_normal((max(1, chunks // 500), dimension)).astype(np.float32))
+    store = VectorStore(path, HashEmbedder(dimension))
+    for start in range(0, chunks, BUILD_BATCH):
+        count = min(BUILD_BATCH, chunks - start)
+        documents: Dict[str, List[Document]] = {}
+        for i in range(start, start + count):
+            source = f"src/{i % SOURCES:04d}/chunk{i}.md"
+            documents[source] = [Document(page_content=f"chunk {i}", metadata={"source": source})]
+        store.upsert(documents, synthetic_vectors(rng, centers, count))
+    store.compact()
+    store.close()
+    return centers
+
+
+def exact_search(store: VectorStore, queries: NDArray[np.float32], k: int) -> NDArray[np.int64]:
+    """
+    The true k nearest chunk ids of each query, scanning every vector
+    """
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(store.ids), BUILD_BATCH):
+        scores = queries @ np.asarray(store.vectors[start:start + BUILD_BATCH]).T
+        ids = np.broadcast_to(np.asarray(store.ids[start:start + BUILD_BATCH]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        keep = np.argsort(-scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, keep, axis=1)
+        best_ids = np.take_along_axis(ids, keep, axis=1)
+    return best_ids
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    return {
+        "p50_ms": round(float(np.percentile(seconds, 50)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(seconds, 99)) * 1000, 3),
+    }
+
+
+def run(chunks: int, dimension: int, queries: int, k: int, nprobe: int, path: str, seed: int = 0) -> Dict[str, Any]:
+    start = time.perf_counter()
+    centers = build(path, chunks, dimension, seed)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    engine = QueryEngine(path, HashEmbedder(dimension))
+    load_ms = (time.perf_counter() - start) * 1000
+
+    query_vectors = synthetic_vectors(np.random.default_rng(seed + 1), centers, queries)
+    truth = exact_search(engine.store, query_vectors, k)
+
+    """
+    One untimed pass first, so latencies are those of a warm index
+    rather than of reading it from disk
+    """
+    engine.search_vectors(query_vectors, k, nprobe=nprobe)
+
+    single: List[float] = []
+    found = 0
+    for i, query in enumerate(query_vectors):
+        start = time.perf_counter()
+        ids, _ = engine.search_vectors(query[np.newaxis], k, nprobe=nprobe)[0]
+        single.append(time.perf_counter() - start)
+        found += len(set(ids.tolist()) & set(truth[i].tolist()))
+
+    start = time.perf_counter()
+    engine.search_vectors(query_vectors, k, nprobe=nprobe)
+    batch_seconds = time.perf_counter() - start
+
+    filtered: List[float] = []
+    for i, query in enumerate(query_vectors):
+        prefix = f"src/{i % 10:03d}"
+        start = time.perf_counter()
+        engine.search_vectors(query[np.newaxis], k, prefix, nprobe)
+        filtered.append(time.perf_counter() - start)
+    engine.close()
+
+    return {
+        "chunks": chunks,
+        "dimension": dimension,
+        "queries": queries,
+        "k": k,
+        "nprobe": nprobe,
+        "build_seconds": round(build_seconds, 3),
+        "load_ms": round(load_ms, 3),
+        f"recall@{k}": round(found / (queries * k), 4),
+        "single": percentiles(single),
+        "batch_ms_per_query": round(batch_seconds / queries * 1000, 3),
+        "filtered_1_percent": percentiles(filtered),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="query_benchmark")
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE)
+    parser.add_argument("--path", help="folder for the index, a temporary one by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        report = run(args.chunks, args.dimension, args.queries, args.k, args.nprobe, args.path or tmp)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import hashlib
+import math
+import random
+import time
+from typing import Callable, List, Optional, cast
+
+from langchain.llms import OpenAIChat
+from langchain.schema import Generation, LLMResult
+from openai.error import RateLimitError
+
+
+class SimulatedChat(OpenAIChat):
+    """
+    An OpenAIChat that answers without calling the API, for benchmarks.
+    Each request takes a log-normally distributed latency around
+    latency_seconds plus the time to generate its output at
+    tokens_per_second, answers with about output_tokens words, and fails
+    with a rate limit error for a rate_limit_ratio share of requests.
+    The answer depends on the prompt, so identical prompts get identical
+    answers and different prompts different ones.
+    """
+
+    latency_seconds: float = 0.5
+    latency_sigma: float = 0.5
+    tokens_per_second: float = 60.0
+    output_tokens: int = 300
+    rate_limit_ratio: float = 0.0
+
+    def _generate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        generations = []
+        prompt_tokens = 0
+        completion_tokens = 0
+        for prompt in prompts:
+            if random.random() < self.rate_limit_ratio:
+                raise rate_limit_error("Rate limit reached for the simulated model")
+
+            seed = int(hashlib.md5(prompt.encode("utf-8")).hexdigest()[:8], 16)
+            tokens = max(1, self.output_tokens // 2 + seed % (self.output_tokens + 1))
+            latency = random.lognormvariate(math.log(self.latency_seconds), self.latency_sigma) \
+                if self.latency_seconds > 0 else 0.0
+            time.sleep(latency + tokens / self.tokens_per_second)
+
+            generations.append([Generation(text=" ".join(f"word{(seed + i) % 1009}" for i in range(tokens)))])
+            prompt_tokens += len(prompt) // 4
+            completion_tokens += tokens
+
+        return LLMResult(
+            generations=generations,
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+                "model_name": self.model_name,
+            },
+        )
+
+
+def simulated_llm_factory(
+        latency_seconds: float = 0.5,
+        latency_sigma: float = 0.5,
+        tokens_per_second: float = 60.0,
+        output_tokens: int = 300,
+        rate_limit_ratio: float = 0.0,
+) -> Callable[[str], OpenAIChat]:
+    """
+    Returns a create_llm for process_repository that gives
+    every model a simulated backend with these settings
+    """
+    def create_llm(model_name: str) -> OpenAIChat:
+        return SimulatedChat.construct(
+            model_name=model_name,
+            latency_seconds=latency_seconds,
+            latency_sigma=latency_sigma,
+            tokens_per_second=tokens_per_second,
+            output_tokens=output_tokens,
+            rate_limit_ratio=rate_limit_ratio,
+        )
+
+    return create_llm
+
+
+def rate_limit_error(message: str) -> RateLimitError:
+    """
+    The errors of openai are untyped, so constructing one is cast
+    """
+    return cast(Callable[[str], RateLimitError], RateLimitError)(message)
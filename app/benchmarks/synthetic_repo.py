@@ -0,0 +1,87 @@
+import os
+import random
+from typing import Dict, List
+
+WORDS = [
+    "account", "batch", "buffer", "cache", "client", "config", "context", "count", "data", "entry",
+    "event", "file", "handler", "index", "item", "key", "limit", "listener", "message", "node",
+    "offset", "options", "parser", "path", "queue", "record", "request", "response", "result", "schema",
+    "session", "source", "state", "stream", "summary", "task", "token", "user", "value", "worker",
+]
+
+
+def synthetic_source(rng: random.Random, size: int) -> str:
+    """
+    Python-like source of about size bytes: classes and functions with
+    made up names, so files tokenize and split like real code
+    """
+    lines: List[str] = []
+    length = 0
+    while length < size:
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}"
+        if rng.random() < 0.2:
+            block = [
+                f"class {name.title().replace('_', '')}:",
+                f"    def __init__(self, {rng.choice(WORDS)}):",
+                f"        self.{rng.choice(WORDS)} = {rng.choice(WORDS)}",
+                "",
+            ]
+        else:
+            first, second = rng.choice(WORDS), rng.choice(WORDS)
+            block = [
+                f"def {name}({first}, {second}={rng.randint(0, 100)}):",
+                f"    \"\"\"Returns the {rng.choice(WORDS)} of the {first} for each {second}\"\"\"",
+                f"    if not {first}:",
+                f"        return {rng.choice(['None', '[]', '0', second])}",
+                f"    return [{second} + item for item in {first}]",
+                "",
+            ]
+        lines.extend(block)
+        length += sum(len(line) + 1 for line in block)
+    return "\n".join(lines) + "\n"
+
+
+def generate_repo(
+        path: str,
+        files: int = 1000,
+        depth: int = 3,
+        folders_per_folder: int = 4,
+        file_size: int = 2000,
+        duplicate_ratio: float = 0.1,
+        seed: int = 0,
+) -> Dict[str, int]:
+    """
+    Writes a repository of synthetic source files under path: every folder
+    has folders_per_folder subfolders down to depth levels, and the files
+    are spread evenly over all folders. A duplicate_ratio share of the
+    files copy the content of an earlier file, as vendored or generated
+    code does. File sizes vary around file_size.
+    Returns the number of files, folders and bytes written.
+    """
+    rng = random.Random(seed)
+    folders = [path]
+    level = [path]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, f"package_{index}")
+            for parent in level
+            for index in range(folders_per_folder)
+        ]
+        folders.extend(level)
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    contents: List[str] = []
+    written = 0
+    for index in range(files):
+        if contents and rng.random() < duplicate_ratio:
+            content = rng.choice(contents)
+        else:
+            content = synthetic_source(rng, max(1, int(rng.uniform(0.5, 1.5) * file_size)))
+            contents.append(content)
+        file_path = os.path.join(folders[index % len(folders)], f"module_{index}.py")
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        written += len(content)
+
+    return {"files": files, "folders": len(folders), "bytes": written}
@@ -0,0 +1,127 @@
+import dataclasses
+import json
+import os.path
+from typing import Dict, List, Any
+
+from ..index.process_repository import process_repository
+from ...utils.llm_util import model_cost, expected_latency, EXPECTED_OUTPUT_TOKENS
+from ...utils.traverse_file_system import traverse_file_system
+from ....data_types import AutodocRepoConfig, LLMModelDetails, ProcessFileParams, ProcessFolderParams, \
+    TraverseFileSystemParams, RateLimits
+
+
+def estimate(config: AutodocRepoConfig) -> Dict[str, Any]:
+    """
+    Estimates what indexing the repository would take now, without calling
+    any model: the calls, tokens and cost for each model of the files and
+    folders that would be summarized, and the projected wall time.
+    The report is written to estimate.json in the output folder.
+    """
+    output = config.output
+    json_dir = os.path.join(output, 'docs', 'json')
+
+    """
+    Run the indexing with the same output as index(), so files and folders
+    that are up to date are not counted
+    """
+    models = process_repository(dataclasses.replace(config, output=json_dir), dry_run=True)
+    files, folders, depth = count_tree(config)
+
+    """
+    Calls are limited by the rate limiter, and by the task workers,
+    which each wait for the summary and the questions of a file at once
+    """
+    concurrency = max(1, min(config.max_concurrent_calls, 2 * config.concurrency))
+    model_reports = [model_report(model, config.rate_limits.get(model.name, RateLimits())) for model in models]
+    used = [report for report in model_reports if report["calls"] > 0]
+
+    throughput_seconds = max(
+        [sum(report["call_seconds"] for report in used) / concurrency]
+        + [report["rate_limited_seconds"] for report in used]
+    )
+
+    """
+    A folder is summarized after all of its subfolders, so the deepest
+    chain of folders is summarized one after the other
+    """
+    folder_latency = max(
+        [expected_latency(report["model"], EXPECTED_OUTPUT_TOKENS["folder"]) for report in used],
+        default=0.0,
+    )
+    critical_path_seconds = depth * folder_latency if used else 0.0
+
+    report: Dict[str, Any] = {
+        "files": files,
+        "folders": folders,
+        "depth": depth,
+        "concurrency": concurrency,
+        "models": model_reports,
+        "calls": sum(model.calls for model in models),
+        "input_tokens": sum(model.input_tokens for model in models),
+        "output_tokens": sum(model.output_tokens for model in models),
+        "cost": round(sum(model_cost(model) for model in models), 6),
+        "throughput_seconds": round(throughput_seconds, 3),
+        "critical_path_seconds": round(critical_path_seconds, 3),
+        "wall_time_seconds": round(max(throughput_seconds, critical_path_seconds), 3),
+    }
+
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, "estimate.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=2))
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def model_report(model: LLMModelDetails, limits: RateLimits) -> Dict[str, Any]:
+    """
+    call_seconds is the time the calls to the model take one after the other,
+    rate_limited_seconds the least time its rate limits allow them to take
+    """
+    call_seconds = model.calls * expected_latency(model.name, model.output_tokens / model.calls) if model.calls else 0.0
+    rate_limited_seconds = 0.0
+    if limits.requests_per_minute:
+        rate_limited_seconds = max(rate_limited_seconds, model.calls / limits.requests_per_minute * 60)
+    if limits.tokens_per_minute:
+        rate_limited_seconds = max(rate_limited_seconds, model.input_tokens / limits.tokens_per_minute * 60)
+    return {
+        "model": model.name,
+        "calls": model.calls,
+        "input_tokens": model.input_tokens,
+        "output_tokens": model.output_tokens,
+        "cost": round(model_cost(model), 6),
+        "call_seconds": round(call_seconds, 3),
+        "rate_limited_seconds": round(rate_limited_seconds, 3),
+    }
+
+
+def count_tree(config: AutodocRepoConfig) -> List[int]:
+    """
+    Returns the number of files and folders that would be indexed
+    and the depth of the deepest folder
+    """
+    counts = [0, 0, 0]
+    root = os.path.abspath(config.root)
+
+    def count_file(params: ProcessFileParams) -> None:
+        counts[0] += 1
+
+    def count_folder(params: ProcessFolderParams) -> None:
+        counts[1] += 1
+        relative_path = os.path.relpath(os.path.abspath(params.folder_path), root)
+        depth = 0 if relative_path == "." else relative_path.count(os.sep) + 1
+        counts[2] = max(counts[2], depth)
+
+    traverse_file_system(TraverseFileSystemParams(
+        input_path=config.root,
+        project_name=config.name,
+        process_file=count_file,
+        process_folder=count_folder,
+        ignore=config.ignore,
+        file_prompt=config.file_prompt,
+        folder_prompt=config.folder_prompt,
+        content_type=config.content_type,
+        target_audience=config.target_audience,
+        link_hosted=config.link_hosted,
+        scan_workers=config.scan_workers,
+    ))
+    return counts
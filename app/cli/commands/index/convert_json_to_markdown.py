@@ -0,0 +1,149 @@
+import functools
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from ...utils.file_util import get_file_name
+from ...utils.summary_store import SummaryStore, Summary
+from ...utils.task_pool import create_task_pool
+from ....data_types import AutodocRepoConfig
+
+
+def render_markdown(summary: Summary) -> str:
+    if len(summary.summary) == 0:
+        return ""
+    questions = f"## Questions: \n {summary.questions}" if summary.questions else ""
+    return f"[View code on GitHub]({summary.url})\n\n{summary.summary}\n{questions}"
+
+
+class MarkdownWriter:
+    """
+    Renders summaries to markdown files under markdown_root, at the paths
+    their JSON files have under json_root. A summary whose markdown has the
+    same checksum as the one last written is skipped; the checksums are
+    kept by JSON path in a database next to the summary store, and loaded
+    on open.
+    Safe to call from many threads, so summaries can be rendered by the
+    workers that produce them.
+    """
+
+    FLUSH_EVERY = 500
+
+    def __init__(self, json_root: str, markdown_root: str):
+        self._json_root = json_root
+        self._markdown_root = markdown_root
+        os.makedirs(json_root, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(json_root, "markdown.sqlite"), check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS markdown (
+                path TEXT PRIMARY KEY,
+                checksum TEXT NOT NULL
+            )
+        """)
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self._checksums: Dict[str, str] = dict(
+            self._connection.execute("SELECT path, checksum FROM markdown").fetchall()
+        )
+        self._dirty: Set[str] = set()
+
+    def markdown_path(self, json_path: str) -> str:
+        return get_file_name(
+            os.path.join(self._markdown_root, os.path.relpath(json_path, self._json_root)), ".", ".md"
+        )
+
+    def write(self, json_path: str, summary: Summary) -> bool:
+        """
+        Returns whether the markdown was written
+        """
+        markdown_path = self.markdown_path(json_path)
+        markdown = render_markdown(summary)
+        checksum = hashlib.md5(markdown.encode("utf-8")).hexdigest()
+        with self._lock:
+            written = self._checksums.get(json_path)
+        if written == checksum and os.path.exists(markdown_path):
+            return False
+
+        os.makedirs(os.path.dirname(markdown_path), exist_ok=True)
+        with open(markdown_path, "w", encoding="utf-8") as f:
+            f.write(markdown)
+        with self._lock:
+            self._checksums[json_path] = checksum
+            self._dirty.add(json_path)
+            should_flush = len(self._dirty) >= self.FLUSH_EVERY
+        if should_flush:
+            self.flush()
+        return True
+
+    def delete_except(self, json_paths: Set[str]) -> None:
+        """
+        Deletes the markdown written for summaries that are not in json_paths
+        """
+        with self._lock:
+            orphans = [path for path in self._checksums if path not in json_paths]
+        for json_path in orphans:
+            try:
+                os.remove(self.markdown_path(json_path))
+            except FileNotFoundError:
+                pass
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM markdown WHERE path = ?", ((path,) for path in orphans))
+            for path in orphans:
+                self._checksums.pop(path, None)
+                self._dirty.discard(path)
+
+    def flush(self) -> None:
+        with self._lock:
+            rows = [(path, self._checksums[path]) for path in self._dirty]
+            self._dirty.clear()
+            if rows:
+                with self._connection:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO markdown (path, checksum) VALUES (?, ?)", rows,
+                    )
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+
+def convert_json_to_markdown(
+        config: AutodocRepoConfig,
+        writer: Optional[MarkdownWriter] = None,
+) -> None:
+    """
+    Renders every summary in the store under config.root to markdown under
+    config.output, a batch at a time on a pool of workers. With the writer
+    that already rendered summaries as they were produced, this pass only
+    picks up what is missing. Markdown of summaries that are not in the
+    store anymore is deleted, so the vector store drops it as well.
+    """
+    input_root = config.root
+    output_root = config.output
+    markdown_writer = writer or MarkdownWriter(input_root, output_root)
+    summary_store = SummaryStore(os.path.join(input_root, "summaries.sqlite"))
+    task_pool = create_task_pool(config.concurrency_backend, config.concurrency)
+
+    def convert(batch: List[Tuple[str, Summary]]) -> None:
+        for json_path, summary in batch:
+            try:
+                markdown_writer.write(json_path, summary)
+            except Exception as e:
+                print(repr(e), file=sys.stderr)
+                print(f"Failed to create markdown for: {json_path}", file=sys.stderr)
+
+    json_paths: Set[str] = set()
+    for batch in summary_store.items():
+        json_paths.update(json_path for json_path, _ in batch)
+        task_pool.submit(functools.partial(convert, batch))
+    task_pool.join()
+    task_pool.shutdown()
+    summary_store.close()
+    markdown_writer.delete_except(json_paths)
+
+    if writer is None:
+        markdown_writer.close()
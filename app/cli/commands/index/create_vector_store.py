@@ -1,71 +1,139 @@
 import os
-from typing import List
+from typing import Dict, Iterator, List, Optional, Set
 
 from langchain.document_loaders.base import BaseLoader
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from ...utils.api_rate_limit import APIRateLimit
+from ...utils.embedding_cache import EmbeddingCache, embed_texts, text_checksum
+from ...utils.embeddings import create_embedder
+from ...utils.metrics import Metrics
+from ...utils.traverse_file_system import SNIFF_SIZE
+from ...utils.vector_store import VectorStore
 from ....data_types import AutodocRepoConfig
 
+# Chunks embedded and written to the store at a time, which bounds
+# the memory used by create_vector_store regardless of the corpus size
+BATCH_CHUNKS = 2000
 
-def readdir(directory_path: str) -> List[str]:
-    files = []
+
+def readdir(directory_path: str) -> Iterator[str]:
+    """
+    os.walk already descends into every subdirectory,
+    so this yields every file below directory_path
+    """
     for dirpath, dirnames, filenames in os.walk(directory_path):
-        for filename in filenames:
-            files.append(os.path.join(dirpath, filename))
-    return files
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
 
 
-def process_file(file_path: str) -> Document:
-    with open(file_path, 'r') as file:
+def process_file(file_path: str, encoding: str = "utf-8") -> Optional[Document]:
+    """
+    Returns None for binary files. Bytes that are not valid in the
+    encoding are replaced rather than failing the whole run.
+    """
+    with open(file_path, 'rb') as file:
         file_contents = file.read()
+    if b"\x00" in file_contents[:SNIFF_SIZE]:
+        return None
     metadata = {"source": file_path}
     doc = Document(
-        page_content=file_contents,
+        page_content=file_contents.decode(encoding, errors="replace"),
         metadata=metadata,
     )
     return doc
 
 
-def process_directory(directory_path: str) -> List[Document]:
-    docs = []
-    try:
-        files = readdir(directory_path)
-    except FileNotFoundError as e:
-        raise Exception(f"Could not read directory: {directory_path}. Did you run `sh download.sh`?") from e
-    for file in files:
-        file_path = os.path.join(directory_path, file)
-        if os.path.isdir(file_path):
-            nested_docs = process_directory(file_path)
-            docs += nested_docs
-        else:
-            doc = process_file(file_path)
-            docs.append(doc)
-    return docs
+def iterate_directory(directory_path: str, encoding: str = "utf-8") -> Iterator[Document]:
+    if not os.path.isdir(directory_path):
+        raise Exception(f"Could not read directory: {directory_path}. Did you run `sh download.sh`?")
+    for file_path in readdir(directory_path):
+        doc = process_file(file_path, encoding)
+        if doc is not None:
+            yield doc
+
+
+def process_directory(directory_path: str, encoding: str = "utf-8") -> List[Document]:
+    return list(iterate_directory(directory_path, encoding))
 
 
 class RepoLoader(BaseLoader):
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, encoding: str = "utf-8"):
         self.file_path = file_path
+        self.encoding = encoding
 
     def load(self) -> List[Document]:
-        return process_directory(self.file_path)
+        return process_directory(self.file_path, self.encoding)
 
+    def lazy_load(self) -> Iterator[Document]:
+        """
+        Yields the documents one at a time, reading each file when it is reached
+        """
+        return iterate_directory(self.file_path, self.encoding)
 
-def create_vector_store(config: AutodocRepoConfig) -> None:
+
+def create_vector_store(config: AutodocRepoConfig, metrics: Optional[Metrics] = None) -> None:
     root = config.root
     output = config.output
 
     loader = RepoLoader(root)
-    raw_docs = loader.load()
 
     # Split the text into chunks
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=8000,
         chunk_overlap=100,
     )
-    docs = text_splitter.split_documents(raw_docs)
-    # TODO
-    # Create the vectorstore
-    # vector_store = HNSWLib.from_documents(docs, OpenAIEmbeddings())
-    # vector_store.save(output)
+
+    """
+    Documents are loaded and split one at a time. Only the chunks of
+    sources that changed since the last run are kept, and they are
+    embedded and written to the store every BATCH_CHUNKS chunks, reusing
+    the vectors of chunks whose text has not changed
+    """
+    embedder = create_embedder(config.embedder)
+    vector_store = VectorStore(output, embedder)
+    cache = EmbeddingCache(os.path.join(config.cache_dir, "embeddings.sqlite")) if config.cache_dir else None
+    seen: Set[str] = set()
+    changed: Dict[str, List[Document]] = {}
+    changed_chunks = 0
+
+    with APIRateLimit(
+            config.max_concurrent_calls,
+            config.rate_limits,
+            max_attempts=config.max_attempts,
+            metrics=metrics,
+    ) as rate_limit:
+        def flush() -> None:
+            vectors = embed_texts(
+                [doc.page_content for docs in changed.values() for doc in docs],
+                embedder,
+                cache,
+                rate_limit,
+                metrics,
+            )
+            vector_store.upsert(changed, vectors)
+            changed.clear()
+
+        for raw_doc in loader.lazy_load():
+            source = str(raw_doc.metadata["source"])
+            seen.add(source)
+            docs = text_splitter.split_documents([raw_doc])
+            if vector_store.checksums(source) == [text_checksum(doc.page_content) for doc in docs]:
+                continue
+            changed[source] = docs
+            changed_chunks += len(docs)
+            if changed_chunks >= BATCH_CHUNKS:
+                flush()
+                changed_chunks = 0
+        if changed:
+            flush()
+
+    if cache is not None:
+        cache.close()
+    vector_store.delete([source for source in vector_store.sources() if source not in seen])
+
+    if vector_store.needs_compaction():
+        vector_store.compact()
+    vector_store.close()
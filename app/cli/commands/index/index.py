@@ -1,55 +1,132 @@
 import dataclasses
+import multiprocessing
 import os.path
+import sys
 
+from .convert_json_to_markdown import convert_json_to_markdown, MarkdownWriter
 from .create_vector_store import create_vector_store
 from .process_repository import process_repository
+from ...utils.metrics import Metrics, write_run_report
+from ...utils.sharding import check_shards, merge_shards, shard_config, shard_root
+from ...utils.summary_store import SummaryStore
 from ....data_types import AutodocRepoConfig
 
 
 def index(config: AutodocRepoConfig) -> None:
+    check_shards(config)
     output = config.output
 
     json = os.path.join(output, 'docs', 'json')
     markdown = os.path.join(output, 'docs', 'markdown')
     data = os.path.join(output, 'docs', 'data')
+    cache = config.cache_dir or os.path.join(output, 'cache')
+    metrics = Metrics()
+
+    """
+    With shards, the files are summarized by one process per shard, here
+    or, with config.shard, on other machines sharing the output folder.
+    The results of the shards are merged before the folders are summarized.
+    """
+    if config.shards > 1:
+        if config.shard is not None:
+            index_shard(config, config.shard)
+            return
+        if not config.merge_only:
+            run_shards(config)
+        merge_shards(json, config.shards)
 
     """
     Traverse the repository, call LLMs for each file,
-    and create JSON files with the results.
+    and store the results in the summary store.
+    Each summary is turned into markdown as soon as it is stored.
     """
 
     # updateSpinnerText('Processing repository...')
-    process_repository(dataclasses.replace(
+    markdown_writer = MarkdownWriter(json, markdown)
+    models = process_repository(dataclasses.replace(
         config,
         output=json,
-    ))
+        cache_dir=cache,
+    ), on_summary=markdown_writer.write, metrics=metrics)
     # updateSpinnerText('Processing repository...')
     # spinnerSuccess()
 
     """
-    Create markdown files from JSON files
+    Create markdown files for summaries that were not
+    stored in this run or have no markdown yet
     """
     # updateSpinnerText('Creating markdown files...')
-    # convert_json_to_markdown({
-    #     "name": name,
-    #     "repositoryUrl": repositoryUrl,
-    #     "root": json_dir,
-    #     "output": markdown_dir,
-    #     "llms": llms,
-    #     "ignore": ignore,
-    #     "filePrompt": filePrompt,
-    #     "folderPrompt": folderPrompt,
-    #     "chatPrompt": chatPrompt,
-    #     "contentType": contentType,
-    #     "targetAudience": targetAudience,
-    #     "linkHosted": linkHosted
-    # })
+    convert_json_to_markdown(dataclasses.replace(
+        config,
+        root=json,
+        output=markdown,
+    ), markdown_writer)
+    markdown_writer.close()
     # spinnerSuccess()
 
+    """
+    Write the summaries as JSON files as well, for tools that read them
+    """
+    if config.export_json:
+        summary_store = SummaryStore(os.path.join(json, "summaries.sqlite"))
+        summary_store.export_json()
+        summary_store.close()
+
     # updateSpinnerText('Create vector files...')
     create_vector_store(dataclasses.replace(
         config,
         root=markdown,
         output=data,
-    ))
+        cache_dir=cache,
+    ), metrics)
     # spinnerSuccess()
+
+    """
+    Write the tokens each model used and the time spent in each stage
+    """
+    write_run_report(os.path.join(output, 'run_report.json'), metrics, models, config.prometheus_report)
+
+
+def index_shard(config: AutodocRepoConfig, shard: int) -> None:
+    """
+    Summarizes the files of a shard with its slice of the rate limits.
+    The markdown of its summaries is written after the merge.
+    """
+    json = os.path.join(config.output, 'docs', 'json')
+    cache = config.cache_dir or os.path.join(config.output, 'cache')
+    metrics = Metrics()
+    models = process_repository(dataclasses.replace(
+        shard_config(config),
+        shard=shard,
+        output=json,
+        cache_dir=cache,
+    ), metrics=metrics)
+    write_run_report(
+        os.path.join(shard_root(json, shard, config.shards), 'run_report.json'),
+        metrics,
+        models,
+        config.prometheus_report,
+    )
+
+
+def run_shards(config: AutodocRepoConfig) -> None:
+    """
+    Runs every shard in a process of its own on this machine
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=index_shard, args=(config, shard)) for shard in range(config.shards)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        """
+        The shards get the interrupt as well and save their progress
+        """
+        for process in processes:
+            process.join()
+        raise
+    for shard, process in enumerate(processes):
+        if process.exitcode != 0:
+            print(f"Shard {shard} of {config.shards} failed with exit code {process.exitcode}", file=sys.stderr)
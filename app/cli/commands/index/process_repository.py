@@ -1,18 +1,34 @@
+import dataclasses
 import hashlib
 import json
 import os
-import re
 import sys
-from typing import List
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Set, Tuple, Union
 from typing import Optional
 
 from langchain.llms import OpenAIChat
-from tiktoken import encoding_for_model
 
-from .prompts import create_code_file_summary, create_code_questions, folder_summary_prompt
+from .prompts import create_code_file_summary, create_code_questions, folder_summary_prompt, \
+    create_code_chunk_summary, combine_chunk_summaries, create_code_file_summary_from_parts, \
+    create_code_questions_from_parts, folder_entry, create_folder_group_summary, folder_summary_prompt_from_groups
 from ...utils.api_rate_limit import APIRateLimit
 from ...utils.file_util import github_file_url, get_file_name, github_folder_url
-from ...utils.traverse_file_system import traverse_file_system
+from ...utils.git_util import git_changed_paths, git_head
+from ...utils.llm_cache import LLMCache
+from ...utils.llm_util import create_llm_models, print_model_details, EXPECTED_OUTPUT_TOKENS
+from ...utils.manifest import Manifest, ManifestEntry, FolderManifestEntry
+from ...utils.metrics import Metrics
+from ...utils.model_router import ModelRouter
+from ...utils.run_journal import RunJournal, FAILED
+from ...utils.sharding import shard_filter, shard_root, seed_shard
+from ...utils.summary_store import SummaryStore, Summary
+from ...utils.task_graph import TaskGraph
+from ...utils.task_pool import create_task_pool
+from ...utils.token_counter import TokenCounter
+from ...utils.traverse_file_system import traverse_file_system, read_file_record
 from ....data_types import AutodocRepoConfig, LLMModelDetails, FileSummary, FolderSummary, TraverseFileSystemParams, \
     ProcessFolderParams, ProcessFileParams
 
@@ -20,7 +36,25 @@ from ....data_types import AutodocRepoConfig, LLMModelDetails, FileSummary, Fold
 def process_repository(
         config: AutodocRepoConfig,
         dry_run: Optional[bool] = None,
-):
+        on_summary: Optional[Callable[[str, Summary], object]] = None,
+        create_llm: Optional[Callable[[str], OpenAIChat]] = None,
+        metrics: Optional[Metrics] = None,
+) -> List[LLMModelDetails]:
+    """
+    Returns the configured models with the usage the provider reported
+    for their calls, which in a dry run is the usage a real run would have.
+    The summaries are kept in summaries.sqlite in the output folder, by the
+    path their JSON file has in the layout of SummaryStore.export_json.
+    on_summary is called with the path and the summary as soon as
+    each summary is stored.
+    create_llm creates the client of each model by name instead of
+    OpenAIChat, such as a simulated backend for benchmarks.
+    The time spent in each stage, in each model and waiting for the rate
+    limiter, and the tokens of each model, are recorded in metrics.
+    With config.shard, only the files of that shard are summarized,
+    in stores of their own that merge_shards merges into the output,
+    and folders are left for the run after the merge.
+    """
     project_name = config.name
     repository_url = config.repository_url
     input_root = config.root
@@ -32,49 +66,265 @@ def process_repository(
     target_audience = config.target_audience
     link_hosted = config.link_hosted
 
-    encoding = encoding_for_model("gpt-3.5-turbo")
-    rate_limit = APIRateLimit(25)
+    """
+    A shard starts its stores from the merged ones, unless it resumes
+    """
+    shard = config.shard if config.shards > 1 else None
+    in_shard = shard_filter(input_root, shard, config.shards) if shard is not None else None
+    state_root = shard_root(output_root, shard, config.shards) if shard is not None else output_root
+    if in_shard is not None and not dry_run and not (
+            config.resume and os.path.exists(os.path.join(state_root, "summaries.sqlite"))
+    ):
+        seed_shard(output_root, state_root, in_shard)
+
+    run_metrics = metrics or Metrics()
+    rate_limit = APIRateLimit(
+        config.max_concurrent_calls,
+        config.rate_limits,
+        max_attempts=config.max_attempts,
+        metrics=run_metrics,
+    )
+    task_pool = create_task_pool(config.concurrency_backend, config.concurrency)
+    manifest = Manifest(os.path.join(state_root, "manifest.sqlite"))
+    summary_store = SummaryStore(os.path.join(state_root, "summaries.sqlite"))
+    token_counter = TokenCounter(manifest, run_metrics)
+    failed = threading.Event()
+    interrupted = threading.Event()
+
+    """
+    A dry run must not change the journal of the real runs, so it keeps its own in memory
+    """
+    journal = RunJournal(":memory:" if dry_run else os.path.join(state_root, "journal.sqlite"))
+    journal.start(bool(config.resume) and not dry_run)
+
+    """
+    With git_incremental, files that git reports as unchanged since the
+    last fully indexed commit are not even stat'ed
+    """
+    head = git_head(input_root) if config.git_incremental else None
+    indexed_commit = manifest.get_meta("indexed_commit") if config.git_incremental else None
+    changed_paths = git_changed_paths(input_root, indexed_commit) if indexed_commit else None
+
+    models = create_llm_models(config.llms, bool(dry_run), create_llm)
+    router = ModelRouter(models, config.model_strategy, config.cost_budget)
+    usage_lock = threading.Lock()
+    no_model = {"file": 0, "folder": 0}
+
+    def no_model_error(kind: str) -> Exception:
+        """
+        Files and folders no model can take within the context and the
+        cost budget fail, so `index --resume` tries them again
+        """
+        with usage_lock:
+            no_model[kind] += 1
+        return Exception("No model fits its prompt within the context and the cost budget")
+    llm_cache = LLMCache(config.cache_dir, config.cache_max_bytes) if config.cache_dir else None
 
     def call_llm(
             prompt: str,
-            model: OpenAIChat,
-    ) -> str:
-        return rate_limit.call_api(lambda: model(prompt))
+            model: LLMModelDetails,
+            tokens: int = 0,
+    ) -> "Future[str]":
+        """
+        Identical requests are answered from the response cache.
+        Every call adds the prompt and completion tokens the provider
+        reports to the usage of the model, or the tokens counted here
+        when it reports none, as when streaming.
+        """
+        llm = model.llm
+        key = LLMCache.key(llm.model_name, prompt, llm.model_kwargs)
+        if llm_cache is not None:
+            cached = llm_cache.get(key)
+            if cached is not None:
+                run_metrics.increment("llm_cache_hits", model=model.name)
+                future: "Future[str]" = Future()
+                future.set_result(cached)
+                return future
+
+        def call() -> str:
+            start = time.monotonic()
+            result = llm.generate([prompt])
+            seconds = time.monotonic() - start
+            router.record_latency(llm.model_name, seconds)
+            run_metrics.observe("llm_seconds", seconds, model=model.name)
+            run_metrics.observe("stage_seconds", seconds, stage="llm")
 
-    def is_model(model: Optional[LLMModelDetails]) -> bool:
-        return model is not None
+            response = result.generations[0][0].text
+            usage = (result.llm_output or {}).get("token_usage") or {}
+            prompt_tokens = int(usage.get("prompt_tokens", tokens))
+            completion_tokens = int(usage.get("completion_tokens", 0)) if "completion_tokens" in usage \
+                else token_counter.count(model.name, response)
+            with usage_lock:
+                model.input_tokens += prompt_tokens
+                model.output_tokens += completion_tokens
+                model.calls += 1
+            run_metrics.increment("llm_calls", model=model.name)
+            run_metrics.increment("llm_tokens", prompt_tokens, model=model.name, kind="prompt")
+            run_metrics.increment("llm_tokens", completion_tokens, model=model.name, kind="completion")
 
-    def process_file(params: ProcessFileParams) -> None:
+            if llm_cache is not None:
+                llm_cache.put(key, response)
+            return response
+
+        return rate_limit.submit(call, llm.model_name, tokens)
+
+    def record_expected_usage(
+            model: LLMModelDetails,
+            input_tokens: int,
+            output_tokens: int,
+            calls: int,
+    ) -> None:
+        """
+        A real run counts the usage of each call as it completes, in
+        call_llm, so the expected usage only counts in a dry run
+        """
+        if dry_run:
+            with usage_lock:
+                model.input_tokens += input_tokens
+                model.output_tokens += output_tokens
+                model.calls += calls
+
+    def file_summary_path(file_path: str, file_name: str) -> str:
+        return os.path.join(os.path.dirname(os.path.join(output_root, file_path)), get_file_name(file_name, ".", ".json"))
+
+    def process_file(params: ProcessFileParams) -> bool:
+        """
+        Returns whether a new summary was written for the file,
+        or in a dry run whether one would be
+        """
         file_name = params.file_name
         file_path = params.file_path
-        project_name = params.project_name
-        content_type = params.content_type
-        file_prompt = params.file_prompt
-        target_audience = params.target_audience
         link_hosted = params.link_hosted
 
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
+        output_path = file_summary_path(file_path, file_name)
+
+        """
+        Files that git reports as unchanged since the last indexed commit,
+        or whose size and modification time match the manifest,
+        are skipped without being read or hashed
+        """
+        if changed_paths is not None and os.path.realpath(file_path) not in changed_paths:
+            entry = manifest.get(file_path)
+            if entry is not None and summary_store.has(entry.output_path):
+                return False
+
+        stat = os.stat(file_path)
+        entry = manifest.unchanged(file_path, stat)
+        if entry is not None and summary_store.has(entry.output_path):
+            return False
+
+        """
+        Read the file once, skipping binary and oversized files,
+        and calculate the checksum of the file content
+        """
+        record = read_file_record(file_path, config.max_file_size, run_metrics)
+        if record is None:
+            return False
+        content = record.text
+        new_checksum = record.checksum
+
+        """
+        Otherwise compare checksums with the stored summary, or with an
+        existing .json file written before summaries were stored, which is
+        moved into the store, to decide if a reindex is needed
+        """
+        old_checksum = summary_store.checksum(output_path)
+        legacy = load_legacy_summary(output_path) if old_checksum is None else None
+        if isinstance(legacy, FileSummary):
+            old_checksum = legacy.checksum
+        if old_checksum == new_checksum:
+            if not dry_run:
+                if isinstance(legacy, FileSummary):
+                    summary_store.put_file(output_path, legacy)
+                manifest.put(ManifestEntry(file_path, record.size, record.mtime_ns, new_checksum, output_path))
+            return False
 
         """
-        Calculate the checksum of the file content
+        Files with identical content are summarized once
         """
-        new_checksum = calculate_checksum([content])
+        result = summarize_deduplicated(file_path, content, new_checksum)
+        if result is None:
+            return False
+        if dry_run:
+            return True
+        summary, questions = result
 
         """
-        If an existing .json file exists,
-        it will check the checksums and decide if a reindex is needed
+        Create file summary and store it
         """
-        reindex = should_reindex(
-            os.path.join(output_root, file_path[0:file_path.rfind("\\")]),
-            re.sub(r"\.[^/.]+$", ".json", file_name),
-            new_checksum,
+        file = FileSummary(
+            file_name=file_name,
+            file_path=file_path,
+            url=github_file_url(repository_url, input_root, file_path, link_hosted),
+            summary=summary,
+            questions=questions,
+            checksum=new_checksum,
         )
-        if not reindex:
-            return
 
-        markdown_file_path = os.path.join(output_root, file_path)
-        url = github_file_url(repository_url, input_root, file_path, link_hosted)
+        with run_metrics.stage("write"):
+            summary_store.put_file(output_path, file)
+            manifest.put(ManifestEntry(file_path, record.size, record.mtime_ns, new_checksum, output_path))
+            if on_summary is not None:
+                on_summary(output_path, file)
+
+        # print(f"File: {file_name} => {output_path}")
+        return True
+
+    summaries_lock = threading.Lock()
+    summaries_by_checksum: Dict[str, "Future[Optional[Tuple[str, str]]]"] = {}
+
+    def summarize_deduplicated(
+            file_path: str,
+            content: str,
+            checksum: str,
+    ) -> Optional[Tuple[str, str]]:
+        """
+        The first file with a given content checksum is summarized and the
+        other files with the same content that are in flight at the same
+        time wait for and reuse its result.
+        The prompts do not include the path, which only goes into the
+        FileSummary of each file, so the result applies to all of them.
+        """
+        with summaries_lock:
+            future = summaries_by_checksum.get(checksum)
+            leader = future is None
+            if future is None:
+                future = summaries_by_checksum[checksum] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = summarize_file(file_path, content, checksum)
+        except Exception as e:
+            """
+            Failures are not reused, later duplicates try again
+            """
+            with summaries_lock:
+                del summaries_by_checksum[checksum]
+            future.set_exception(e)
+            raise
+
+        future.set_result(result)
+        """
+        Once the result is in the response cache, later duplicates are
+        answered from there, so it does not need to stay in memory
+        """
+        if llm_cache is not None and not dry_run:
+            with summaries_lock:
+                del summaries_by_checksum[checksum]
+        return result
+
+    def summarize_file(
+            file_path: str,
+            content: str,
+            checksum: str,
+    ) -> Optional[Tuple[str, str]]:
+        """
+        Returns the summary and questions for a file, empty in a dry run,
+        or None in a dry run if no model could take it.
+        Raises if no model could take it or the calls failed.
+        """
         summary_prompt = create_code_file_summary(
             project_name,
             project_name,
@@ -89,172 +339,581 @@ def process_repository(
             content_type,
             target_audience,
         )
-        summary_length = len(encoding.encode(summary_prompt))
-        question_length = len(encoding.encode(questions_prompt))
-        # max_length = max(question_length, summary_length)
-
         """
-        TODO: Encapsulate logic for selecting the best model
-        TODO: Allow for different selection strategies based
-        TODO: preference for cost/performance
-        TODO: When this is re-written, it should use the correct
-        TODO: TikToken encoding for each model
+        The file contents are tokenized once per encoding and the
+        templates are counted without them, instead of encoding both
+        full prompts for every model
         """
+        summary_template = create_code_file_summary(project_name, project_name, "", content_type, file_prompt)
+        questions_template = create_code_questions(project_name, project_name, "", content_type, target_audience)
 
-        model: Optional[LLMModelDetails] = None  # TODO
+        def prompt_length(model_name: str) -> int:
+            return max(
+                token_counter.count_prompt(model_name, summary_template, checksum, content),
+                token_counter.count_prompt(model_name, questions_template, checksum, content),
+            )
 
-        if not is_model(model):
-            # print(f"Skipped {file_path} | Length ${max_length}")
-            return
+        """
+        Select the model for this file with the configured strategy,
+        reserving the summary and the questions calls.
+        Files too large for any model are summarized in chunks instead.
+        """
+        model = router.select(prompt_length, calls=2)
+        chunked = model is None and not router.fits_any(prompt_length)
+        if chunked:
+            model = select_chunk_model(checksum, content)
+
+        if model is None:
+            if dry_run:
+                return None
+            raise no_model_error("file")
 
         try:
-            if not dry_run:
-                """ Call LLM """
-                # TODO parallel
-                summary, questions = (
-                    call_llm(summary_prompt, model.llm),
-                    call_llm(questions_prompt, model.llm)
+            summary, questions = "", ""
+            if chunked:
+                summary, questions, input_tokens, output_tokens, calls = summarize_in_chunks(file_path, content, model)
+            else:
+                input_tokens = (
+                    token_counter.count_prompt(model.name, summary_template, checksum, content)
+                    + token_counter.count_prompt(model.name, questions_template, checksum, content)
                 )
+                output_tokens = EXPECTED_OUTPUT_TOKENS["summary"] + EXPECTED_OUTPUT_TOKENS["questions"]
+                calls = 2
+                if not dry_run:
+                    """ Call LLM """
+                    summary_future = call_llm(summary_prompt, model, input_tokens // 2)
+                    questions_future = call_llm(questions_prompt, model, input_tokens // 2)
+                    summary, questions = summary_future.result(), questions_future.result()
 
-                """
-                Create file and save to disk
-                """
-                file = FileSummary(
-                    file_name=file_name,
-                    file_path=file_path,
-                    url=url,
-                    summary=summary,
-                    questions=questions,
-                    checksum=new_checksum,
-                )
+            """
+            Track usage for end of run summary
+            """
+            record_expected_usage(model, input_tokens, output_tokens, calls)
+            with usage_lock:
+                model.total += 1
+                model.succeeded += 1
+            return summary, questions
+        except Exception:
+            with usage_lock:
+                model.failed += 1
+            raise
 
-                output_path = get_file_name(markdown_file_path, ".", ".json")
-                content = json.dumps(file, indent=2) if len(file.summary) > 0 else ""
+    def select_chunk_model(checksum: str, content: str) -> Optional[LLMModelDetails]:
+        """
+        Chunks are about half of chunk_tokens, and their summaries are
+        merged into the summary and the questions, so the budget reserves
+        a call for each chunk and two more
+        """
+        chunk_template = create_code_chunk_summary(project_name, project_name, "", 1, 1, content_type)
+        content_tokens = max((token_counter.count_content(model.name, checksum, content) for model in models), default=0)
+        chunks = -(-content_tokens // max(1, config.chunk_tokens // 2))
+        return router.select(
+            lambda model_name: token_counter.count_template(model_name, chunk_template) + config.chunk_tokens,
+            calls=chunks + 2,
+        )
 
-                """
-                Create the output directory if it doesn't exist
-                """
-                try:
-                    os.makedirs(markdown_file_path.replace(file_name, ""), exist_ok=True)
-                    with open(output_path, "w", encoding="utf-8") as f:
-                        f.write(content)
-                except Exception as e:
-                    print(repr(e), file=sys.stderr)
-                    return
+    def summarize_in_chunks(
+            file_path: str,
+            content: str,
+            model: LLMModelDetails,
+    ) -> Tuple[str, str, int, int, int]:
+        """
+        Map-reduce summary of a file that does not fit in the context of any
+        model: the file is split on token budgets, the chunks are summarized
+        in parallel, and the summary and questions are written from the
+        chunk summaries, reducing them again while they are still too long.
+        Chunk summaries are cached by model, template and chunk hash, not by
+        position, so after an edit only the chunks that changed are
+        summarized again.
+        Returns the summary, the questions, the input tokens, the expected
+        output tokens and the number of calls.
+        """
+        chunk_template = create_code_chunk_summary(project_name, project_name, "", 1, 1, content_type)
+        chunk_tokens = min(
+            config.chunk_tokens,
+            model.max_length - router.output_tokens - token_counter.count_template(model.name, chunk_template),
+        )
+        input_tokens = 0
+        calls = 0
 
-                # print(f"File: {file_name} => {output_path}")
+        def summarize_chunks(text: str) -> List[str]:
+            nonlocal input_tokens, calls
+            chunks = token_counter.split(model.name, text, chunk_tokens)
+            results: List[Union[str, "Future[str]"]] = []
+            prompts = []
+            for part, chunk in enumerate(chunks, start=1):
+                prompt = create_code_chunk_summary(project_name, project_name, chunk, part, len(chunks), content_type)
+                key = calculate_checksum([model.name, chunk_template, chunk])
+                cached = manifest.get_chunk_summary(key)
+                prompts.append((key, prompt))
+                if cached is not None:
+                    results.append(cached)
+                    continue
+                tokens = token_counter.count(model.name, prompt)
+                input_tokens += tokens
+                calls += 1
+                results.append(call_llm(prompt, model, tokens) if not dry_run else "")
 
-            """
-            Track usage for end of run summary
-            """
-            model.input_tokens += summary_length + question_length
-            model.total += 1
-            model.output_tokens += 1000
-            model.succeeded += 1
+            summaries = []
+            for (key, prompt), result in zip(prompts, results):
+                if isinstance(result, str):
+                    summaries.append(result)
+                else:
+                    summaries.append(result.result())
+                    manifest.put_chunk_summary(key, summaries[-1])
+            return summaries
+
+        summaries = summarize_chunks(content)
+        while True:
+            part_summaries = combine_chunk_summaries(summaries)
+            summary_prompt = create_code_file_summary_from_parts(
+                project_name,
+                project_name,
+                part_summaries,
+                content_type,
+                file_prompt,
+            )
+            questions_prompt = create_code_questions_from_parts(
+                project_name,
+                project_name,
+                part_summaries,
+                content_type,
+                target_audience,
+            )
+            summary_length = token_counter.count(model.name, summary_prompt)
+            question_length = token_counter.count(model.name, questions_prompt)
+            if dry_run or len(summaries) == 1 or max(summary_length, question_length) + router.output_tokens <= model.max_length:
+                break
+            summaries = summarize_chunks(part_summaries)
+
+        input_tokens += summary_length + question_length
+        calls += 2
+        output_tokens = (
+            (calls - 2) * EXPECTED_OUTPUT_TOKENS["chunk"]
+            + EXPECTED_OUTPUT_TOKENS["summary"]
+            + EXPECTED_OUTPUT_TOKENS["questions"]
+        )
+        if dry_run:
+            return "", "", input_tokens, output_tokens, calls
+
+        summary_future = call_llm(summary_prompt, model, summary_length)
+        questions_future = call_llm(questions_prompt, model, question_length)
+        return summary_future.result(), questions_future.result(), input_tokens, output_tokens, calls
+
+    task_graph = TaskGraph(task_pool)
+    pending_lock = threading.Lock()
+    pending_files: Dict[str, List["Future[bool]"]] = {}
+    pending_folders: Dict[str, List["Future[bool]"]] = {}
+    visited: Set[str] = set()
+
+    def save_results() -> None:
+        with run_metrics.stage("write"):
+            summary_store.flush()
+            manifest.flush()
+
+    def run_task(path: str, kind: str, task: Callable[[], bool]) -> bool:
+        """
+        Runs the task of a file or folder and records it in the journal.
+        In a resumed run, tasks that were done return their recorded result
+        without running again. After an interrupt, tasks that have not
+        started are left for the next run.
+        Failures are raised again after they are recorded, so the folders
+        above know about them.
+        """
+        resumed = journal.resumed_result(path)
+        if resumed is not None:
+            return resumed
+        if interrupted.is_set():
+            return False
+
+        journal.running(path, kind)
+        start = time.monotonic()
+        try:
+            changed = task()
         except Exception as e:
-            print(repr(e))
-            print(f"Failed to get summary for file {file_name}", file=sys.stderr)
-            model.failed += 1
+            if interrupted.is_set():
+                return False
+            print(repr(e), file=sys.stderr)
+            print(f"Failed to process {kind} {path}", file=sys.stderr)
+            failed.set()
+            if journal.failed(path, kind, repr(e), time.monotonic() - start):
+                journal.flush(save_results)
+            raise
+        if journal.done(path, kind, changed, time.monotonic() - start):
+            journal.flush(save_results)
+        return changed
 
-    def process_folder(params: ProcessFolderParams) -> None:
+    def submit_file(params: ProcessFileParams) -> None:
+        """
+        Hands the file to the worker pool so reading, prompting, LLM calls
+        and writing for many files overlap instead of running one by one
+        """
+        with pending_lock:
+            visited.add(file_summary_path(params.file_path, params.file_name))
+        if in_shard is not None and not in_shard(params.file_path):
+            return
+        journal.pending(params.file_path, "file")
+        future = task_pool.submit(lambda: run_task(params.file_path, "file", lambda: process_file(params)))
+        with pending_lock:
+            pending_files.setdefault(os.path.dirname(params.file_path), []).append(future)
+
+    def process_folder(params: ProcessFolderParams, dirty: bool) -> bool:
+        """
+        Returns whether a new summary was written for the folder,
+        or in a dry run whether one would be.
+        A folder that is not dirty, whose listing is unchanged and that
+        already has a summary is skipped without reading its children.
+        """
         folder_name = params.folder_name
         folder_path = params.folder_path
         project_name = params.project_name
         content_type = params.content_type
         folder_prompt = params.folder_prompt
-        should_ignore = params.should_ignore
         link_hosted = params.link_hosted
 
         """
-        For now we don't care about folders
-
-        TODO: Add support for folders during estimation
+        The children come from the walk of the input folder, so the output
+        folder does not need to be listed and filtered again
         """
+        file_names = [get_file_name(file_name, ".", ".json") for file_name in params.file_names]
+        folder_names = params.folder_names
+        listing = calculate_checksum(file_names + [f"{folder_name}/" for folder_name in folder_names])
+        summary_path = os.path.join(folder_path, "summary.json")
+
+        entry = manifest.get_folder(folder_path)
+        if not dirty and entry is not None and entry.listing == listing and summary_store.has(summary_path):
+            return False
+
         if dry_run:
-            return
+            return estimate_folder(params)
+
+        url = github_folder_url(repository_url, input_root, folder_path, link_hosted)
+        file_paths = [
+            os.path.join(folder_path, file_name) for file_name in file_names if file_name != "summary.json"
+        ]
+        folder_paths = [os.path.join(folder_path, folder_name, "summary.json") for folder_name in folder_names]
 
-        contents = [file_name for file_name in os.listdir(folder_path) if not should_ignore(file_name)]
+        """
+        The summaries of the children are read from the store,
+        without their own children
+        """
+        children = summary_store.get_many(file_paths + folder_paths)
+        files = [
+            file for file in (children.get(path) for path in file_paths)
+            if isinstance(file, FileSummary) and len(file.summary) > 0
+        ]
+        folders = [
+            folder for folder in (children.get(path) for path in folder_paths)
+            if isinstance(folder, FolderSummary)
+        ]
+        if not files and not folders:
+            return False
 
         """
-        Get the checksum of the folder
+        Get the Merkle checksum of the folder from the content and
+        summaries of its children
         """
-        new_checksum = calculate_checksum(contents)
+        new_checksum = folder_checksum(files, folders)
 
         """
-        If an existing summary.json file exists,
-        it will check the checksums and decide if a reindex is needed
+        If the folder already has a summary, or a summary.json file written
+        before summaries were stored, compare the checksums to decide if
+        a reindex is needed
         """
-        reindex = should_reindex(
+        old_checksum = summary_store.checksum(summary_path)
+        legacy = load_legacy_summary(summary_path) if old_checksum is None else None
+        if isinstance(legacy, FolderSummary):
+            old_checksum = legacy.checksum
+        if old_checksum == new_checksum:
+            if isinstance(legacy, FolderSummary):
+                summary_store.put_folder(summary_path, legacy, file_paths, folder_paths)
+            manifest.put_folder(FolderManifestEntry(folder_path, new_checksum, listing))
+            return False
+        if not models:
+            raise no_model_error("folder")
+
+        prompt = folder_summary_prompt(
             folder_path,
-            "summary.json",
-            new_checksum,
+            project_name,
+            files,
+            folders,
+            content_type,
+            folder_prompt,
         )
-        if not reindex:
-            return
 
-        url = github_folder_url(repository_url, input_root, folder_path, link_hosted)
-        all_files = []
-        for file_name in contents:
-            entry_path = os.path.join(folder_path, file_name)
-
-            if os.path.isfile(entry_path) and file_name != "summary.json":
-                with open(entry_path, "r", encoding="utf-8") as f:
-                    file = f.read()
-                all_files.append(json.loads(file) if len(file) > 0 else None)
-            else:
-                all_files.append(None)
+        """
+        Folders whose children take more than folder_tokens,
+        or that no model can take at once, are summarized in groups
+        """
+        template = folder_summary_prompt(folder_path, project_name, [], [], content_type, folder_prompt)
+        prompt_lengths = {model.name: token_counter.count(model.name, prompt) for model in models}
+        grouped = not router.fits_any(prompt_lengths.__getitem__) or any(
+            length - token_counter.count_template(model_name, template) > config.folder_tokens
+            for model_name, length in prompt_lengths.items()
+        )
+        if grouped:
+            children_tokens = max(
+                length - token_counter.count_template(model_name, template)
+                for model_name, length in prompt_lengths.items()
+            )
+            model = select_group_model(folder_path, children_tokens)
+        else:
+            model = router.select(prompt_lengths.__getitem__)
+        if model is None:
+            raise no_model_error("folder")
 
-        try:
-            files = [file for file in all_files if file is not None]
-            all_folders = []
-            for file_name in contents:
-                entry_path = os.path.join(folder_path, file_name)
-
-                if os.path.isdir(entry_path):
-                    try:
-                        summary_file_path = os.path.join(entry_path, "summary.json")
-                        with open(summary_file_path, "r", encoding="utf-8") as f:
-                            file = f.read()
-                        all_folders.append(json.loads(file))
-                    except:
-                        print(f"Skipped: {folder_path}")
-                        all_folders.append(None)
+        if grouped:
+            entries = [(file.file_name, file.summary) for file in files] + \
+                      [(f"{folder.folder_name}/", folder.summary) for folder in folders]
+            summary, input_tokens, output_tokens, calls = summarize_folder_in_groups(folder_path, entries, model)
+        else:
+            input_tokens = prompt_lengths[model.name]
+            summary = call_llm(prompt, model, input_tokens).result()
+            output_tokens = EXPECTED_OUTPUT_TOKENS["folder"]
+            calls = 1
+        record_expected_usage(model, input_tokens, output_tokens, calls)
+
+        folder_summary = FolderSummary(
+            folder_name=folder_name,
+            folder_path=folder_path,
+            url=url,
+            files=[],
+            folders=[],
+            summary=summary,
+            questions="",
+            checksum=new_checksum,
+        )
+
+        with run_metrics.stage("write"):
+            summary_store.put_folder(summary_path, folder_summary, file_paths, folder_paths)
+            manifest.put_folder(FolderManifestEntry(folder_path, new_checksum, listing))
+            if on_summary is not None:
+                on_summary(summary_path, folder_summary)
+
+        # print(f"Folder: {folder_name} => {summary_path}")
+        return True
+
+    def group_tokens(model: LLMModelDetails, group_template: str) -> int:
+        """
+        Groups take at most folder_tokens, less when the context of the
+        model cannot hold that much next to the template and the output.
+        The template names the folder, so it is counted without the cache.
+        """
+        return min(
+            config.folder_tokens,
+            model.max_length - router.output_tokens - token_counter.count(model.name, group_template),
+        )
+
+    def expected_groups(children_tokens: int, tokens: int) -> int:
+        """
+        Groups are packed to about half of their budget
+        """
+        return -(-children_tokens // max(1, tokens // 2))
+
+    def select_group_model(folder_path: str, children_tokens: int) -> Optional[LLMModelDetails]:
+        """
+        Models are compared on the groups they can take, and the budget
+        reserves the group calls of the smallest groups with the call
+        that merges them
+        """
+        group_template = create_folder_group_summary(folder_path, project_name, [], 1, 1, content_type)
+        budgets = {model.name: group_tokens(model, group_template) for model in models}
+        groups = expected_groups(
+            children_tokens, min((budget for budget in budgets.values() if budget > 0), default=config.folder_tokens),
+        )
+        return router.select(
+            lambda model_name: token_counter.count(model_name, group_template) + max(1, budgets[model_name]),
+            calls=groups + 1,
+        )
+
+    def summarize_folder_in_groups(
+            folder_path: str,
+            entries: List[Tuple[str, str]],
+            model: LLMModelDetails,
+    ) -> Tuple[str, int, int, int]:
+        """
+        Summary of a folder whose children do not fit in one prompt: the
+        names and summaries of the children are packed into groups of at
+        most folder_tokens tokens, the groups are summarized in parallel,
+        and the folder summary is written from the group summaries,
+        grouping them again while they are still too long.
+        Group summaries are cached like chunk summaries, so after a change
+        only the groups whose children changed are summarized again.
+        Returns the summary, the input tokens, the expected output tokens
+        and the number of calls.
+        """
+        group_template = create_folder_group_summary(folder_path, project_name, [], 1, 1, content_type)
+        max_tokens = group_tokens(model, group_template)
+        input_tokens = 0
+        calls = 0
+
+        def pack(entries: List[Tuple[str, str]]) -> List[List[Tuple[str, str]]]:
+            """
+            Groups also end after entries whose name hashes to a boundary,
+            so adding or removing a child only changes the group around it.
+            The boundary rate is picked so groups are about half of
+            max_tokens.
+            """
+            lengths = [token_counter.count(model.name, folder_entry(name, summary)) for name, summary in entries]
+            rate = max(1, max_tokens * len(entries) // max(1, 2 * sum(lengths)))
+            groups: List[List[Tuple[str, str]]] = [[]]
+            size = 0
+            for entry, length in zip(entries, lengths):
+                if groups[-1] and size + length > max_tokens:
+                    groups.append([])
+                    size = 0
+                groups[-1].append(entry)
+                size += length
+                if len(groups[-1]) > 1 and int(calculate_checksum([entry[0]]), 16) % rate == 0:
+                    groups.append([])
+                    size = 0
+            return [group for group in groups if group]
+
+        def summarize_groups(groups: List[List[Tuple[str, str]]]) -> List[str]:
+            nonlocal input_tokens, calls
+            results: List[Union[str, "Future[str]"]] = []
+            keys = []
+            for part, group in enumerate(groups, start=1):
+                group_entries = [folder_entry(name, summary) for name, summary in group]
+                key = calculate_checksum([model.name, group_template] + group_entries)
+                cached = manifest.get_chunk_summary(key)
+                keys.append(key)
+                if cached is not None:
+                    results.append(cached)
+                    continue
+                prompt = create_folder_group_summary(
+                    folder_path, project_name, group_entries, part, len(groups), content_type,
+                )
+                tokens = token_counter.count(model.name, prompt)
+                input_tokens += tokens
+                calls += 1
+                results.append(call_llm(prompt, model, tokens))
+
+            summaries = []
+            for key, result in zip(keys, results):
+                if isinstance(result, str):
+                    summaries.append(result)
                 else:
-                    all_folders.append(None)
-
-            folders = [folder for folder in all_folders if folder is not None]
-
-            summary = call_llm(
-                folder_summary_prompt(
-                    folder_path,
-                    project_name,
-                    files,
-                    folders,
-                    content_type,
-                    folder_prompt,
-                ),
-                OpenAIChat(),  # TODO
-            )
+                    summaries.append(result.result())
+                    manifest.put_chunk_summary(key, summaries[-1])
+            return summaries
 
-            folder_summary = FolderSummary(
-                folder_name=folder_name,
-                folder_path=folder_path,
-                url=url,
-                files=files,
-                folders=[folder for folder in folders if folder],
-                summary=summary,
-                questions="",
-                checksum=new_checksum,
+        template_tokens = token_counter.count(
+            model.name, folder_summary_prompt_from_groups(folder_path, project_name, "", content_type, folder_prompt),
+        )
+        summaries = summarize_groups(pack(entries))
+        while True:
+            prompt = folder_summary_prompt_from_groups(
+                folder_path,
+                project_name,
+                combine_chunk_summaries(summaries),
+                content_type,
+                folder_prompt,
             )
+            prompt_tokens = token_counter.count(model.name, prompt)
+            if prompt_tokens - template_tokens <= config.folder_tokens \
+                    and prompt_tokens + router.output_tokens <= model.max_length:
+                break
+            groups = pack([(f"Group {part}", summary) for part, summary in enumerate(summaries, start=1)])
+            if len(groups) == len(summaries):
+                """
+                Packing no longer shrinks the summaries, which is only
+                a problem if they do not fit in the context of the model
+                """
+                if prompt_tokens + router.output_tokens > model.max_length:
+                    raise Exception(f"The summaries of its {len(summaries)} groups do not fit in the context of {model.name}")
+                break
+            summaries = summarize_groups(groups)
 
-            output_path = os.path.join(folder_path, "summary.json")
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(json.dumps(folder_summary, indent=2))
+        input_tokens += prompt_tokens
+        calls += 1
+        output_tokens = (calls - 1) * EXPECTED_OUTPUT_TOKENS["chunk"] + EXPECTED_OUTPUT_TOKENS["folder"]
+        return call_llm(prompt, model, prompt_tokens).result(), input_tokens, output_tokens, calls
 
-            # print(f"Folder: {folder_name} => {output_path}")
-        except Exception as e:
-            print(repr(e))
-            print(f"Failed to get summary for folder: {folder_path}")
+    def estimate_folder(params: ProcessFolderParams) -> bool:
+        """
+        Accounts for the folder summary a real run would request, with the
+        summaries of the children, which do not exist yet, counted at their
+        expected length
+        """
+        prompt = folder_summary_prompt(
+            params.folder_path,
+            project_name,
+            [FileSummary(file_name, "", "", "", "", "") for file_name in params.file_names],
+            [FolderSummary(folder_name, "", "", [], [], "", "", "") for folder_name in params.folder_names],
+            content_type,
+            folder_prompt,
+        )
+        children_tokens = (
+            len(params.file_names) * EXPECTED_OUTPUT_TOKENS["summary"]
+            + len(params.folder_names) * EXPECTED_OUTPUT_TOKENS["folder"]
+        )
+
+        def prompt_length(model_name: str) -> int:
+            return token_counter.count_template(model_name, prompt) + children_tokens
+
+        if children_tokens <= config.folder_tokens and router.fits_any(prompt_length):
+            model = router.select(prompt_length)
+            if model is None:
+                return False
+            record_expected_usage(model, prompt_length(model.name), EXPECTED_OUTPUT_TOKENS["folder"], 1)
+            return True
+
+        """
+        Groups are packed to about half of what the model
+        can take, and merged in a single call
+        """
+        model = select_group_model(params.folder_path, children_tokens)
+        if model is None:
+            return False
+        group_template = create_folder_group_summary(params.folder_path, project_name, [], 1, 1, content_type)
+        groups = expected_groups(children_tokens, group_tokens(model, group_template))
+        merge_template = folder_summary_prompt_from_groups(params.folder_path, project_name, "", content_type, folder_prompt)
+        record_expected_usage(
+            model,
+            children_tokens
+            + groups * token_counter.count(model.name, group_template)
+            + token_counter.count(model.name, merge_template)
+            + groups * EXPECTED_OUTPUT_TOKENS["chunk"],
+            groups * EXPECTED_OUTPUT_TOKENS["chunk"] + EXPECTED_OUTPUT_TOKENS["folder"],
+            groups + 1,
+        )
+        return True
+
+    def submit_folder(params: ProcessFolderParams) -> None:
+        """
+        Called after the walk has visited everything below the folder,
+        so all of its file tasks and subfolder nodes are known.
+        The folder is summarized from the summaries of its children under
+        the mirrored path in the output, and is dirty if any of its files
+        or subfolders got a new summary.
+        """
+        input_folder_path = params.folder_path
+        output_params = dataclasses.replace(
+            params,
+            input_path=output_root,
+            folder_path=os.path.join(output_root, input_folder_path),
+        )
+        with pending_lock:
+            dependencies = pending_files.pop(input_folder_path, []) + pending_folders.pop(input_folder_path, [])
+            visited.add(os.path.join(output_params.folder_path, "summary.json"))
+
+        def run() -> bool:
+            """
+            A folder is summarized from the children that succeeded, but
+            fails as well if any did, so a resumed run summarizes it again
+            """
+            dirty = any(dependency.exception() is None and dependency.result() for dependency in dependencies)
+            changed = process_folder(output_params, dirty)
+            failed_children = sum(dependency.exception() is not None for dependency in dependencies)
+            if failed_children > 0:
+                raise Exception(f"{failed_children} of its files and folders failed")
+            return changed
+
+        journal.pending(input_folder_path, "folder")
+        future = task_graph.add(lambda: run_task(input_folder_path, "folder", run), dependencies)
+        with pending_lock:
+            pending_folders.setdefault(os.path.dirname(input_folder_path), []).append(future)
 
     # def files_and_folders() -> Dict[str, int]:
     #     """
@@ -305,41 +964,86 @@ def process_repository(
 
     """
     Create markdown files for each code file in the project
+    and markdown summaries for each folder in the project.
+
+    Both run in a single walk: every folder becomes a node in a
+    dependency graph and is summarized as soon as its own files and
+    subfolders are done, so independent subtrees run in parallel.
     """
 
-    # update_spinner_text(f"Processing {files} files...")
-    traverse_file_system(TraverseFileSystemParams(
-        input_path=input_root,
-        project_name=project_name,
-        process_file=process_file,
-        process_folder=None,
-        ignore=ignore,
-        file_prompt=file_prompt,
-        folder_prompt=folder_prompt,
-        content_type=content_type,
-        target_audience=target_audience,
-        link_hosted=link_hosted,
-    ))
-    # spinner_success(f"Processing {files} files...")
+    # update_spinner_text(f"Processing {files} files and {folders} folders...")
+    try:
+        walk_start = time.perf_counter()
+        traverse_file_system(TraverseFileSystemParams(
+            input_path=input_root,
+            project_name=project_name,
+            process_file=submit_file,
+            process_folder=submit_folder if in_shard is None else None,
+            ignore=ignore,
+            file_prompt=file_prompt,
+            folder_prompt=folder_prompt,
+            content_type=content_type,
+            target_audience=target_audience,
+            link_hosted=link_hosted,
+            scan_workers=config.scan_workers,
+        ))
+        run_metrics.observe("stage_seconds", time.perf_counter() - walk_start, stage="walk")
+        task_pool.join()
+        task_graph.join()
+    except KeyboardInterrupt:
+        """
+        Calls that have not started are cancelled and tasks that have not
+        started are skipped, then everything that is done is saved
+        """
+        print("Interrupted, saving progress. Run `index --resume` to continue.", file=sys.stderr)
+        interrupted.set()
+        failed.set()
+        rate_limit.shutdown(wait=False, cancel_pending=True)
+        task_pool.join()
+        task_graph.join()
+    # spinner_success(f"Processing {files} files and {folders} folders...")
+    # stop_spinner()
+
+    task_pool.shutdown()
+    rate_limit.shutdown()
 
     """
-    Create markdown summaries for each folder in the project
+    The summaries of files and folders the walk no longer reaches, because
+    they were deleted or are now ignored, are removed, so their markdown
+    and their chunks in the vector store are removed too. A shard only
+    walks part of the repository, so it keeps everything.
     """
-    # update_spinner_text(f"Processing {folders} folders... ")
-    traverse_file_system(TraverseFileSystemParams(
-        input_path=output_root,
-        project_name=project_name,
-        process_file=None,
-        process_folder=process_folder,
-        ignore=ignore,
-        file_prompt=file_prompt,
-        folder_prompt=folder_prompt,
-        content_type=content_type,
-        target_audience=target_audience,
-        link_hosted=link_hosted,
-    ))
-    # spinner_success(f"Processing {folders} folders... ")
-    # stop_spinner()
+    if not dry_run and in_shard is None and not interrupted.is_set():
+        summary_store.delete([path for path in summary_store.paths() if path not in visited])
+
+    """
+    Only remember the commit if every file and folder was indexed,
+    otherwise the next run must look at everything again
+    """
+    if not dry_run:
+        manifest.set_meta("indexed_commit", head if not failed.is_set() else None)
+    journal_counts = journal.counts()
+    journal.close(save_results)
+    summary_store.close()
+    manifest.close()
+
+    print_model_details(models)
+    if llm_cache is not None:
+        print(f"LLM cache: {llm_cache.stats()}")
+    if interrupted.is_set():
+        raise KeyboardInterrupt
+    if no_model["file"] > 0 or no_model["folder"] > 0:
+        print(
+            f"Skipped {no_model['file']} files and {no_model['folder']} folders "
+            f"that no model fits within the context and the cost budget.",
+            file=sys.stderr,
+        )
+    if journal_counts[FAILED] > 0:
+        print(
+            f"{journal_counts[FAILED]} files and folders failed. Run `index --resume` to retry them.",
+            file=sys.stderr,
+        )
+    return models
 
 
 def calculate_checksum(contents: List[str]) -> str:
@@ -355,33 +1059,40 @@ def calculate_checksum(contents: List[str]) -> str:
     return final_checksum
 
 
-def should_reindex(
-        content_path: str,
-        name: str,
-        new_checksum: str,
-) -> bool:
+def folder_checksum(
+        files: List[FileSummary],
+        folders: List[FolderSummary],
+) -> str:
     """
-    Checks if a summary.json file exists.
-    If it does, compares the checksums to see if it
-    needs to be re-indexed or not.
+    Calculates the Merkle checksum of a folder from the names,
+    content checksums and summaries of its files and subfolders,
+    so it changes whenever anything below the folder changes
     """
-    json_path = os.path.join(content_path, name)
-
-    summary_exists = os.access(json_path, os.F_OK)
-
-    if summary_exists:
-        with open(json_path, "r", encoding="utf-8") as f:
-            file_contents = f.read()
-        file_contents_json = json.loads(file_contents)
+    children = [
+        f"{file.file_name}:{file.checksum}:{calculate_checksum([file.summary])}"
+        for file in files
+    ] + [
+        f"{folder.folder_name}/:{folder.checksum}:{calculate_checksum([folder.summary])}"
+        for folder in folders
+    ]
+    return calculate_checksum(sorted(children))
 
-        old_checksum = file_contents_json["checksum"]
 
-        if old_checksum == new_checksum:
-            print(f"Skipping {json_path} because it has not changed")
-            return False
-        else:
-            print(f"Reindexing {json_path} because it has changed")
-            return True
+def load_legacy_summary(json_path: str) -> Optional[Summary]:
+    """
+    Reads a summary from a JSON file written before summaries were stored,
+    without the children a folder summary embeds.
+    Returns None if there is no such file or it is empty.
+    """
+    if not os.path.isfile(json_path):
+        return None
+    with open(json_path, "r", encoding="utf-8") as f:
+        file_contents = f.read()
+    if len(file_contents) == 0:
+        return None
 
-    # if no summary then generate one
-    return True
+    data = json.loads(file_contents)
+    if os.path.basename(json_path) == "summary.json":
+        data["files"], data["folders"] = [], []
+        return FolderSummary(**data)
+    return FileSummary(**data)
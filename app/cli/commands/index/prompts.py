@@ -45,6 +45,14 @@ def create_code_questions(
     """
 
 
+def folder_entry(name: str, summary: str) -> str:
+    return f"""
+        Name: {name}
+        Summary: {summary}
+        
+        """
+
+
 def folder_summary_prompt(
         folder_path: str,
         project_name: str,
@@ -53,22 +61,8 @@ def folder_summary_prompt(
         content_type: str,
         folder_prompt: str
 ) -> str:
-    files_str = ",".join(
-        f"""
-        Name: {file.file_name}
-        Summary: {file.summary}
-        
-        """
-        for file in files
-    )
-    folders_str = ",".join(
-        f"""
-        Name: {folder.folder_name}
-        Summary: {folder.summary}
-        
-        """
-        for folder in folders
-    )
+    files_str = ",".join(folder_entry(file.file_name, file.summary) for file in files)
+    folders_str = ",".join(folder_entry(folder.folder_name, folder.summary) for folder in folders)
 
     return f"""
     You are acting as a {content_type} documentation expert for a project called {project_name}.
@@ -88,3 +82,131 @@ def folder_summary_prompt(
 
     Response:
     """
+
+
+def create_folder_group_summary(
+        folder_path: str,
+        project_name: str,
+        entries: List[str],
+        part: int,
+        parts: int,
+        content_type: str,
+) -> str:
+    """
+    Subfolders are listed by their name followed by a slash
+    """
+    entries_str = ",".join(entries)
+
+    return f"""
+    You are acting as a {content_type} documentation expert for a project called {project_name}.
+    You are currently documenting the folder located at `{folder_path}`.
+    The folder has too many files and subfolders to document at once, so they are summarized in groups.
+    Below is group {part} of {parts}: a list of files and subfolders and a summary of the contents of each:
+
+    {entries_str}
+
+    Write a concise technical summary of what this group of files and subfolders does
+    and how they work together. Keep your response under 200 words.
+
+    Summary:
+    
+    """
+
+
+def folder_summary_prompt_from_groups(
+        folder_path: str,
+        project_name: str,
+        group_summaries: str,
+        content_type: str,
+        folder_prompt: str
+) -> str:
+    return f"""
+    You are acting as a {content_type} documentation expert for a project called {project_name}.
+    You are currently documenting the folder located at `{folder_path}`. 
+    The folder has too many files and subfolders to show at once.
+    Below are summaries of consecutive groups of its files and subfolders.
+
+    Summaries:
+    {group_summaries}
+
+    {folder_prompt}
+    Do not say "this file is a part of the {project_name} project".
+    Do not just list the files and folders.
+
+    Response:
+    """
+
+
+def create_code_chunk_summary(
+        file_path: str,
+        project_name: str,
+        chunk_contents: str,
+        part: int,
+        parts: int,
+        content_type: str,
+) -> str:
+    return f"""
+    You are acting as a {content_type} documentation expert for a project called {project_name}.
+    Below is part {part} of {parts} of the {content_type} from a file located at `{file_path}`.
+    The file is too large to document at once, so each part is summarized separately.
+    Write a concise technical summary of what this part does, naming the important
+    classes, functions and how they relate to the rest of the file.
+    Keep your response under 200 words.
+
+    {content_type}:
+    {chunk_contents}
+
+    Summary:
+    
+    """
+
+
+def combine_chunk_summaries(summaries: List[str]) -> str:
+    return "\n\n".join(
+        f"Summary of part {part} of {len(summaries)}:\n{summary}"
+        for part, summary in enumerate(summaries, start=1)
+    )
+
+
+def create_code_file_summary_from_parts(
+        file_path: str,
+        project_name: str,
+        part_summaries: str,
+        content_type: str,
+        file_prompt: str
+) -> str:
+    return f"""
+    You are acting as a {content_type} documentation expert for a project called {project_name}.
+    The {content_type} in the file located at `{file_path}` is too large to show at once.
+    Below are summaries of its consecutive parts.
+    {file_prompt}
+    Do not say "this file is a part of the {project_name} project".
+
+    Summaries:
+    {part_summaries}
+
+    Response:
+    
+    """
+
+
+def create_code_questions_from_parts(
+        file_path: str,
+        project_name: str,
+        part_summaries: str,
+        content_type: str,
+        target_audience: str
+) -> str:
+    return f"""
+    You are acting as a {content_type} documentation expert for a project called {project_name}.
+    The {content_type} in the file located at `{file_path}` is too large to show at once.
+    Below are summaries of its consecutive parts.
+    What are 3 questions that a {target_audience} might have about this {content_type}? 
+    Answer each question in 1-2 sentences. Output should be in markdown format.
+
+    Summaries:
+    {part_summaries}
+
+    Questions and Answers:
+    
+    """
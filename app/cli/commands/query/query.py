@@ -0,0 +1,57 @@
+import os.path
+import sys
+from typing import List, Optional
+
+from ...utils.embeddings import create_embedder
+from ...utils.query_engine import QueryEngine
+from ....data_types import AutodocRepoConfig, SearchResult
+
+
+def print_results(question: str, results: List[SearchResult]) -> None:
+    print(question)
+    for result in results:
+        print(f"  {result.score:.4f}  {result.document.metadata.get('source', '')}")
+
+
+def markdown_prefix(config: AutodocRepoConfig, source_prefix: str) -> str:
+    """
+    The sources in the index are the markdown files, whose paths are the
+    paths of the JSON summaries relative to the JSON folder, joined to the
+    markdown folder. A prefix relative to the repository goes through the
+    same steps, and keeps a trailing separator so it only matches a folder.
+    """
+    json_root = os.path.join(config.output, 'docs', 'json')
+    markdown_root = os.path.join(config.output, 'docs', 'markdown')
+    relative = os.path.relpath(os.path.join(json_root, config.root, source_prefix), json_root)
+    prefix = os.path.join(markdown_root, relative) if relative != os.curdir else markdown_root
+    return prefix + os.sep if source_prefix.endswith(("/", os.sep)) or relative == os.curdir else prefix
+
+
+def query(
+        config: AutodocRepoConfig,
+        questions: List[str],
+        k: int = 4,
+        source_prefix: Optional[str] = None,
+        rerank: bool = False,
+) -> None:
+    """
+    Searches the index built by index() for the questions, all in one batch.
+    Without questions, serves one question per line of the standard input
+    until it is closed, so the index is only loaded once.
+    """
+    data = os.path.join(config.output, 'docs', 'data')
+    if source_prefix:
+        source_prefix = markdown_prefix(config, source_prefix)
+    engine = QueryEngine(data, create_embedder(config.embedder))
+    try:
+        if questions:
+            for question, results in zip(questions, engine.search(questions, k, source_prefix, rerank)):
+                print_results(question, results)
+            return
+        for line in sys.stdin:
+            question = line.strip()
+            if question:
+                print_results(question, engine.search([question], k, source_prefix, rerank)[0])
+                sys.stdout.flush()
+    finally:
+        engine.close()
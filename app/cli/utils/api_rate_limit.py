@@ -1,14 +1,259 @@
-from typing import List, Callable, TypeVar
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from .metrics import Metrics
+from .retry import RATE_LIMIT_ATTEMPTS, backoff_delay, is_rate_limit_error
+from ...data_types import RateLimits
 
 T = TypeVar('T')
 
 
+class TokenBucket:
+    """
+    A token bucket refilled continuously at `capacity` tokens per minute.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._rate = capacity / 60.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def try_acquire(self, amount: float) -> float:
+        """
+        Takes `amount` tokens if they are available and returns 0,
+        otherwise returns the number of seconds until they will be.
+        Requests larger than the bucket are capped to its capacity
+        so they can still go through once the bucket is full.
+        """
+        amount = min(amount, self._capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self._rate
+
+    def release(self, amount: float) -> None:
+        with self._lock:
+            self._tokens = min(self._capacity, self._tokens + amount)
+
+
+@dataclass
+class _Call:
+    api_function: Callable[[], object]
+    future: "Future[object]"
+    model: Optional[str]
+    tokens: int
+    attempts: int = 0
+    rate_limited_attempts: int = 0
+    not_before: float = 0.0
+    queued: float = field(default_factory=time.monotonic)
+
+
 class APIRateLimit:
-    def __init__(self, max_concurrent_calls: int = 50):
-        self._queue: List[Callable[[], None]] = []
+    """
+    Runs API calls on a pool of worker threads, with at most
+    `max_concurrent_calls` in flight, while keeping each model under
+    its requests-per-minute and tokens-per-minute limits.
+
+    Failed calls are queued again after an exponential backoff with jitter,
+    up to `max_attempts` attempts. Rate limit errors are counted separately,
+    with up to RATE_LIMIT_ATTEMPTS attempts and longer delays, and also
+    hold back the other calls to the same model until the delay is over.
+
+    How long each call waited in the queue and every retry are recorded
+    in `metrics`, by model.
+    """
+
+    def __init__(
+            self,
+            max_concurrent_calls: int = 50,
+            limits: Optional[Dict[str, RateLimits]] = None,
+            default_limits: Optional[RateLimits] = None,
+            max_attempts: int = 1,
+            metrics: Optional[Metrics] = None,
+    ):
+        self._queue: Deque[_Call] = deque()
         self._in_progress = 0
         self._max_concurrent_calls = max_concurrent_calls
+        self._limits = dict(limits or {})
+        self._default_limits = default_limits or RateLimits()
+        self._buckets: Dict[Optional[str], Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+        self._max_attempts = max_attempts
+        self._paused_until: Dict[Optional[str], float] = {}
+        self._metrics = metrics or Metrics()
+        self._condition = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._closed = False
+
+    def set_limits(self, model: str, limits: RateLimits) -> None:
+        with self._condition:
+            self._limits[model] = limits
+            self._buckets.pop(model, None)
+
+    def call_api(
+            self,
+            api_function: Callable[[], T],
+            model: Optional[str] = None,
+            tokens: int = 0,
+    ) -> T:
+        return self.submit(api_function, model, tokens).result()
+
+    def submit(
+            self,
+            api_function: Callable[[], T],
+            model: Optional[str] = None,
+            tokens: int = 0,
+    ) -> "Future[T]":
+        """
+        Queues `api_function` and returns a future for its result.
+        `tokens` is the expected token usage of the call, charged
+        against the tokens-per-minute bucket of `model`.
+        """
+        future: "Future[T]" = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("APIRateLimit has been shut down")
+            self._queue.append(_Call(api_function, future, model, tokens))  # type: ignore[arg-type]
+            self._start_worker()
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait: bool = True, cancel_pending: bool = False) -> None:
+        """
+        With cancel_pending, calls that have not started yet are cancelled
+        instead of being run first
+        """
+        with self._condition:
+            self._closed = True
+            if cancel_pending:
+                for call in self._queue:
+                    if not call.future.cancel():
+                        call.future.set_exception(CancelledError())
+                self._queue.clear()
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def __enter__(self) -> "APIRateLimit":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.shutdown()
+
+    def _start_worker(self) -> None:
+        idle = len(self._workers) - self._in_progress
+        if len(self._workers) < self._max_concurrent_calls and idle < len(self._queue):
+            worker = threading.Thread(target=self._work, daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _buckets_for(self, model: Optional[str]) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        if model not in self._buckets:
+            limits = self._limits.get(model, self._default_limits) if model else self._default_limits
+            self._buckets[model] = (
+                TokenBucket(limits.requests_per_minute) if limits.requests_per_minute else None,
+                TokenBucket(limits.tokens_per_minute) if limits.tokens_per_minute else None,
+            )
+        return self._buckets[model]
+
+    def _next_call(self) -> Optional[_Call]:
+        """
+        Picks the first queued call whose model has capacity, so a
+        throttled model does not hold up calls to the others.
+        Retries are not picked before their backoff is over.
+        """
+        with self._condition:
+            while True:
+                if not self._queue and self._closed:
+                    return None
+                wait: Optional[float] = None
+                throttled = set()
+                now = time.monotonic()
+                for call in self._queue:
+                    if call.model in throttled:
+                        continue
+                    paused = self._paused_until.get(call.model, 0.0) - now
+                    if paused > 0.0:
+                        throttled.add(call.model)
+                        wait = paused if wait is None else min(wait, paused)
+                        continue
+                    if call.not_before > now:
+                        delay = call.not_before - now
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                    requests, tokens = self._buckets_for(call.model)
+                    delay = requests.try_acquire(1) if requests else 0.0
+                    if delay == 0.0 and tokens:
+                        delay = tokens.try_acquire(call.tokens)
+                        if delay > 0.0 and requests:
+                            requests.release(1)
+                    if delay == 0.0:
+                        self._queue.remove(call)
+                        self._in_progress += 1
+                        return call
+                    throttled.add(call.model)
+                    wait = delay if wait is None else min(wait, delay)
+                self._condition.wait(wait)
+
+    def _work(self) -> None:
+        while True:
+            call = self._next_call()
+            if call is None:
+                return
+            self._metrics.observe("rate_limit_wait_seconds", time.monotonic() - call.queued, model=call.model or "")
+            retried = call.attempts + call.rate_limited_attempts > 0
+            if retried or call.future.set_running_or_notify_cancel():
+                try:
+                    call.future.set_result(call.api_function())
+                except Exception as e:
+                    if not self._retry(call, e):
+                        call.future.set_exception(e)
+                except BaseException as e:
+                    call.future.set_exception(e)
+            with self._condition:
+                self._in_progress -= 1
+                self._condition.notify()
+
+    def _retry(self, call: _Call, error: Exception) -> bool:
+        """
+        Queues the call again after its backoff, if it has attempts left
+        """
+        rate_limited = is_rate_limit_error(error)
+        if rate_limited:
+            call.rate_limited_attempts += 1
+            attempt = call.rate_limited_attempts
+            if attempt >= RATE_LIMIT_ATTEMPTS:
+                return False
+        else:
+            call.attempts += 1
+            attempt = call.attempts
+            if attempt >= self._max_attempts:
+                return False
 
-    def call_api(self, api_function: Callable[[], T]) -> T:
-        # TODO
-        return api_function()
+        delay = backoff_delay(attempt, rate_limited)
+        print(f"Retrying a call to {call.model} in {delay:.1f}s after: {error!r}", file=sys.stderr)
+        self._metrics.increment("api_retries", model=call.model or "", reason="rate_limit" if rate_limited else "error")
+        """
+        The backoff is not counted as waiting in the queue
+        """
+        call.not_before = call.queued = time.monotonic() + delay
+        with self._condition:
+            if rate_limited:
+                self._paused_until[call.model] = max(self._paused_until.get(call.model, 0.0), call.not_before)
+            self._queue.append(call)
+            self._condition.notify()
+        return True
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from .api_rate_limit import APIRateLimit
+from .embeddings import Embedder
+from .metrics import Metrics
+from .token_counter import TokenCounter
+
+
+def text_checksum(text: str) -> str:
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent map of (embedder, text checksum) to the vector of the text,
+    stored in a SQLite database as raw float32 bytes
+    """
+
+    # Most checksums looked up in one query
+    LOOKUP_BATCH = 500
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                embedder TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (embedder, checksum)
+            )
+        """)
+        self._lock = threading.Lock()
+
+    def get_many(self, embedder: str, checksums: List[str]) -> Dict[str, NDArray[np.float32]]:
+        vectors = {}
+        with self._lock:
+            for start in range(0, len(checksums), self.LOOKUP_BATCH):
+                batch = checksums[start:start + self.LOOKUP_BATCH]
+                rows = self._connection.execute(
+                    f"SELECT checksum, vector FROM embeddings "
+                    f"WHERE embedder = ? AND checksum IN ({','.join('?' * len(batch))})",
+                    [embedder] + batch,
+                )
+                for checksum, vector in rows:
+                    vectors[checksum] = np.frombuffer(vector, dtype=np.float32)
+        return vectors
+
+    def put_many(self, embedder: str, vectors: Dict[str, NDArray[np.float32]]) -> None:
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (embedder, checksum, vector) VALUES (?, ?, ?)",
+                (
+                    (embedder, checksum, np.asarray(vector, dtype=np.float32).tobytes())
+                    for checksum, vector in vectors.items()
+                ),
+            )
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def embed_texts(
+        texts: List[str],
+        embedder: Embedder,
+        cache: Optional[EmbeddingCache] = None,
+        rate_limit: Optional[APIRateLimit] = None,
+        metrics: Optional[Metrics] = None,
+) -> NDArray[np.float32]:
+    """
+    Returns the vectors of texts, one row per text.
+    Only texts that are not in the cache are embedded, each distinct text
+    once. They are packed into batches of at most max_batch_size texts and
+    max_batch_tokens tokens of the embedder, and the batches are sent
+    concurrently through the rate limiter. Vectors are cached as their
+    batch completes, so an interrupted run keeps what it paid for.
+    Embedding calls are timed as the embed stage of metrics.
+    """
+    run_metrics = metrics or Metrics()
+    checksums = [text_checksum(text) for text in texts]
+    vectors = cache.get_many(embedder.name, list(set(checksums))) if cache is not None else {}
+
+    missing: Dict[str, str] = {}
+    for checksum, text in zip(checksums, texts):
+        if checksum not in vectors:
+            missing.setdefault(checksum, text)
+
+    token_counter = TokenCounter(metrics=run_metrics)
+    batches: List[Tuple[List[Tuple[str, str]], int]] = []
+    batch: List[Tuple[str, str]] = []
+    batch_tokens = 0
+    for checksum, text in missing.items():
+        tokens = token_counter.count(embedder.name, text)
+        if batch and (len(batch) >= embedder.max_batch_size or batch_tokens + tokens > embedder.max_batch_tokens):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+        batch.append((checksum, text))
+        batch_tokens += tokens
+    if batch:
+        batches.append((batch, batch_tokens))
+
+    def embed_batch(batch: List[Tuple[str, str]]) -> Dict[str, NDArray[np.float32]]:
+        with run_metrics.stage("embed"):
+            embedded = embedder.embed([text for _, text in batch])
+        result = {checksum: embedded[i] for i, (checksum, _) in enumerate(batch)}
+        if cache is not None:
+            cache.put_many(embedder.name, result)
+        return result
+
+    limiter = rate_limit or APIRateLimit(metrics=run_metrics)
+    try:
+        futures: List["Future[Dict[str, NDArray[np.float32]]]"] = [
+            limiter.submit(lambda batch=batch: embed_batch(batch), embedder.name, batch_tokens)  # type: ignore[misc]
+            for batch, batch_tokens in batches
+        ]
+        for future in futures:
+            vectors.update(future.result())
+    finally:
+        if rate_limit is None:
+            limiter.shutdown()
+
+    if not texts:
+        return np.zeros((0, embedder.dimension), dtype=np.float32)
+    stacked: NDArray[np.float32] = np.stack([vectors[checksum] for checksum in checksums]).astype(np.float32, copy=False)
+    return stacked
@@ -0,0 +1,91 @@
+import abc
+import re
+import zlib
+from typing import List, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+from langchain.embeddings import OpenAIEmbeddings
+
+
+class Embedder(abc.ABC):
+    """
+    Turns texts into unit-length float32 vectors, so the dot product
+    of two vectors is their cosine similarity.
+    name identifies the embedder and its configuration in a persisted
+    index, as vectors of different embedders cannot be compared.
+    """
+
+    name: str
+    dimension: int
+
+    # Largest number of texts and of tokens sent to the embedder in one call
+    max_batch_size = 1000
+    max_batch_tokens = 50000
+
+    @abc.abstractmethod
+    def embed(self, texts: List[str]) -> NDArray[np.float32]:
+        ...
+
+    def embed_query(self, text: str) -> NDArray[np.float32]:
+        vector: NDArray[np.float32] = self.embed([text])[0]
+        return vector
+
+
+class HashEmbedder(Embedder):
+    """
+    Deterministic local embedder that hashes the words of a text into
+    signed buckets. It needs no model or network, so it is meant for
+    tests and offline runs; texts sharing words get similar vectors.
+    """
+
+    def __init__(self, dimension: int = 256):
+        self.name = f"hash-{dimension}"
+        self.dimension = dimension
+
+    def embed(self, texts: List[str]) -> NDArray[np.float32]:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = zlib.crc32(word.encode("utf-8"))
+                vectors[row, h % self.dimension] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors)
+
+
+class OpenAIEmbedder(Embedder):
+    def __init__(self, model: str = "text-embedding-ada-002", dimension: int = 1536):
+        self.name = model
+        self.dimension = dimension
+        self._model = model
+        self._embeddings: Optional[OpenAIEmbeddings] = None
+
+    def embed(self, texts: List[str]) -> NDArray[np.float32]:
+        """
+        The client is created on first use, so an index
+        can be loaded without an API key. The client argument
+        is filled in by the validation of OpenAIEmbeddings.
+        Batches are retried by APIRateLimit, not by the client.
+        """
+        if self._embeddings is None:
+            self._embeddings = OpenAIEmbeddings(client=None, model=self._model, max_retries=0)
+        vectors = np.array(self._embeddings.embed_documents(texts), dtype=np.float32)
+        return normalize(vectors.reshape(len(texts), self.dimension))
+
+
+def create_embedder(name: str) -> Embedder:
+    """
+    "hash" or "hash-<dimension>" for the local embedder,
+    otherwise the name of an OpenAI embedding model
+    """
+    if name == "hash":
+        return HashEmbedder()
+    if name.startswith("hash-"):
+        return HashEmbedder(int(name[len("hash-"):]))
+    return OpenAIEmbedder(name)
+
+
+def normalize(vectors: NDArray[np.float32]) -> NDArray[np.float32]:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    normalized: NDArray[np.float32] = (vectors / norms).astype(np.float32)
+    return normalized
@@ -0,0 +1,55 @@
+import os
+import subprocess
+from typing import List, Optional, Set
+
+
+def _git(cwd: str, args: List[str]) -> Optional[str]:
+    """
+    The output is decoded like file names are, so paths
+    in it compare equal to the paths of the files
+    """
+    try:
+        result = subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            capture_output=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return os.fsdecode(result.stdout)
+
+
+def git_head(root: str) -> Optional[str]:
+    """
+    Returns the commit checked out in root, or None if root is not
+    in a git repository or the working tree has uncommitted changes,
+    since such a tree cannot be described by a commit alone.
+    Untracked files, such as the output folder inside the repository,
+    do not count: git_changed_paths always reports them as changed.
+    """
+    head = _git(root, ["rev-parse", "HEAD"])
+    status = _git(root, ["status", "--porcelain", "--untracked-files=no"])
+    if head is None or status is None or status.strip():
+        return None
+    return head.strip()
+
+
+def git_changed_paths(root: str, since_commit: str) -> Optional[Set[str]]:
+    """
+    Returns the absolute paths of files that differ between since_commit
+    and the working tree, including untracked files,
+    or None if that cannot be determined.
+    Paths are listed with -z, as git otherwise quotes and escapes
+    paths with special or non-ASCII characters.
+    """
+    top_level = _git(root, ["rev-parse", "--show-toplevel"])
+    changed = _git(root, ["diff", "--name-only", "--no-renames", "-z", since_commit])
+    untracked = _git(root, ["ls-files", "--others", "--exclude-standard", "--full-name", "-z"])
+    if top_level is None or changed is None or untracked is None:
+        return None
+    return {
+        os.path.join(os.path.realpath(top_level.strip()), path)
+        for path in changed.split("\0") + untracked.split("\0")
+        if path
+    }
@@ -0,0 +1,119 @@
+import os
+import re
+from typing import List, Optional, Pattern
+
+
+def _translate(pattern: str) -> str:
+    """
+    Translates the glob part of a gitignore pattern into a regex
+    that matches a path relative to the root, with `/` as separator
+    """
+    result = ""
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            result += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i) and i + 2 == n and (i == 0 or pattern[i - 1] == "/"):
+            result += ".*"
+            i += 2
+        elif c == "*":
+            result += "[^/]*"
+            i += 1
+        elif c == "?":
+            result += "[^/]"
+            i += 1
+        elif c == "[":
+            """
+            A ] right after [ or [! is part of the set rather than closing it,
+            and a [ that is never closed is a literal
+            """
+            start = i + 2 if pattern.startswith("[!", i) or pattern.startswith("[^", i) else i + 1
+            end = pattern.find("]", start + 1)
+            if end == -1:
+                result += re.escape(c)
+                i += 1
+            else:
+                body = pattern[start:end].replace("\\", "\\\\").replace("[", "\\[").replace("]", "\\]")
+                result += "[" + ("^" if start > i + 1 else "") + body + "]"
+                i = end + 1
+        elif c == "\\" and i + 1 < n:
+            result += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            result += re.escape(c)
+            i += 1
+    return result
+
+
+class IgnoreMatcher:
+    """
+    Matches paths against a list of ignore patterns with .gitignore
+    semantics: later patterns override earlier ones, `!` negates,
+    a trailing `/` only matches directories, and a pattern containing
+    a `/` is anchored to the root while any other pattern matches a
+    name at any depth.
+    All patterns are compiled into one regex for files and one for
+    directories, so each check is a single match.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self._negated: List[bool] = []
+        file_alternatives: List[str] = []
+        dir_alternatives: List[str] = []
+
+        for raw in patterns:
+            pattern = raw.rstrip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            if negated:
+                pattern = pattern[1:]
+            elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            anchored = "/" in pattern
+            regex = _translate(pattern.lstrip("/"))
+            if not anchored:
+                regex = "(?:.*/)?" + regex
+
+            group = f"(?P<p{len(self._negated)}>{regex})"
+            self._negated.append(negated)
+            dir_alternatives.append(group)
+            if not dir_only:
+                file_alternatives.append(group)
+
+        """
+        Alternatives are tried in order, so reversing them makes
+        the last matching pattern win, as in .gitignore
+        """
+        self._file_regex = self._compile(file_alternatives)
+        self._dir_regex = self._compile(dir_alternatives)
+
+    @staticmethod
+    def _compile(alternatives: List[str]) -> Optional[Pattern[str]]:
+        if not alternatives:
+            return None
+        return re.compile("|".join(reversed(alternatives)))
+
+    def ignored(self, path: str, is_dir: bool = False) -> bool:
+        """
+        Checks a path relative to the root, using `/` or os.sep
+        """
+        regex = self._dir_regex if is_dir else self._file_regex
+        if regex is None:
+            return False
+        if os.sep != "/":
+            path = path.replace(os.sep, "/")
+        match = regex.fullmatch(path)
+        if match is None or match.lastgroup is None:
+            return False
+        return not self._negated[int(match.lastgroup[1:])]
+
+    def should_ignore(self, file_name: str) -> bool:
+        return self.ignored(file_name)
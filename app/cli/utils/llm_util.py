@@ -0,0 +1,97 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain.llms import OpenAIChat
+
+from ...data_types import LLMModelDetails
+
+# Input and output cost per 1k tokens and context length of the known models
+MODEL_PRICING: Dict[str, Tuple[float, float, int]] = {
+    "gpt-3.5-turbo": (0.0015, 0.002, 4096),
+    "gpt-3.5-turbo-16k": (0.003, 0.004, 16384),
+    "gpt-4": (0.03, 0.06, 8192),
+    "gpt-4-32k": (0.06, 0.12, 32768),
+}
+
+# Rough output tokens per second of each model, used to project wall time
+MODEL_OUTPUT_TOKENS_PER_SECOND: Dict[str, float] = {
+    "gpt-3.5-turbo": 60.0,
+    "gpt-3.5-turbo-16k": 60.0,
+    "gpt-4": 20.0,
+    "gpt-4-32k": 20.0,
+}
+
+# Fixed overhead of a request in seconds, on top of generating the output
+REQUEST_LATENCY_SECONDS = 0.5
+
+# Expected output tokens of each kind of request, from the length limits
+# in the prompts (about 4 tokens for every 3 words)
+EXPECTED_OUTPUT_TOKENS: Dict[str, int] = {
+    "summary": 400,
+    "questions": 200,
+    "chunk": 270,
+    "folder": 530,
+}
+
+
+def create_llm_models(
+        names: List[str],
+        dry_run: bool = False,
+        create_llm: Optional[Callable[[str], OpenAIChat]] = None,
+) -> List[LLMModelDetails]:
+    """
+    Creates the details and client of each configured model once,
+    so they are shared by every request of a run.
+    A dry run never calls the models, so their clients are created
+    without validation and do not need an API key.
+    create_llm creates the client of a model by name instead,
+    such as a simulated backend for benchmarks.
+    Clients make a single attempt per call, so failed calls are retried
+    by APIRateLimit, which backs off without holding a worker, pauses the
+    model on rate limit errors and keeps the retries out of the latency.
+    The client argument is filled in by the validation of OpenAIChat.
+    """
+    models = []
+    for name in names:
+        if name not in MODEL_PRICING:
+            raise ValueError(f"Unknown model: {name}. Known models are {', '.join(MODEL_PRICING)}")
+        input_cost, output_cost, max_length = MODEL_PRICING[name]
+        if create_llm is not None:
+            llm = create_llm(name)
+        elif dry_run:
+            llm = OpenAIChat.construct(model_name=name, model_kwargs={"temperature": 0.1}, max_retries=1)
+        else:
+            llm = OpenAIChat(client=None, model_name=name, model_kwargs={"temperature": 0.1}, max_retries=1)
+        models.append(LLMModelDetails(
+            name=name,
+            input_cost_per_1k_tokens=input_cost,
+            output_cost_per_1k_tokens=output_cost,
+            max_length=max_length,
+            llm=llm,
+            input_tokens=0,
+            output_tokens=0,
+            succeeded=0,
+            failed=0,
+            total=0,
+        ))
+    return models
+
+
+def expected_latency(model_name: str, output_tokens: float) -> float:
+    return REQUEST_LATENCY_SECONDS + output_tokens / MODEL_OUTPUT_TOKENS_PER_SECOND.get(model_name, 30.0)
+
+
+def model_cost(model: LLMModelDetails) -> float:
+    return (
+        model.input_tokens / 1000 * model.input_cost_per_1k_tokens
+        + model.output_tokens / 1000 * model.output_cost_per_1k_tokens
+    )
+
+
+def print_model_details(models: List[LLMModelDetails]) -> None:
+    for model in models:
+        print(
+            f"{model.name}: {model.total} files, {model.succeeded} succeeded, {model.failed} failed, "
+            f"{model.input_tokens} input tokens, {model.output_tokens} output tokens, "
+            f"${model_cost(model):.4f}"
+        )
+    print(f"Total cost: ${sum(model_cost(model) for model in models):.4f}")
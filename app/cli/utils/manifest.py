@@ -0,0 +1,232 @@
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, astuple
+from typing import Callable, Dict, Optional, Set, Tuple
+
+
+@dataclass
+class ManifestEntry:
+    path: str
+    size: int
+    mtime_ns: int
+    checksum: str
+    output_path: str
+
+
+@dataclass
+class FolderManifestEntry:
+    path: str
+    checksum: str
+    listing: str
+
+
+class Manifest:
+    """
+    Persistent map of input path to (size, mtime, checksum, output path)
+    for every indexed file, plus the Merkle checksum and child listing
+    of every summarized folder, the token counts of file contents and
+    the summaries of chunks of large files, stored in a single SQLite database.
+    The whole table is loaded on open so lookups never touch the disk;
+    changes are written back in batches.
+    """
+
+    FLUSH_EVERY = 500
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                output_path TEXT NOT NULL
+            )
+        """)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY,
+                checksum TEXT NOT NULL,
+                listing TEXT NOT NULL
+            )
+        """)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS token_counts (
+                encoding TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (encoding, checksum)
+            )
+        """)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_summaries (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL
+            )
+        """)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        """)
+        self._lock = threading.Lock()
+        self._entries: Dict[str, ManifestEntry] = {
+            row[0]: ManifestEntry(*row)
+            for row in self._connection.execute("SELECT path, size, mtime_ns, checksum, output_path FROM files")
+        }
+        self._folders: Dict[str, FolderManifestEntry] = {
+            row[0]: FolderManifestEntry(*row)
+            for row in self._connection.execute("SELECT path, checksum, listing FROM folders")
+        }
+        self._token_counts: Dict[Tuple[str, str], int] = {
+            (row[0], row[1]): row[2]
+            for row in self._connection.execute("SELECT encoding, checksum, count FROM token_counts")
+        }
+        self._dirty: Set[str] = set()
+        self._dirty_folders: Set[str] = set()
+        self._dirty_token_counts: Set[Tuple[str, str]] = set()
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        with self._lock:
+            return self._entries.get(path)
+
+    def unchanged(self, path: str, stat: os.stat_result) -> Optional[ManifestEntry]:
+        """
+        Returns the entry for path if the file still has the recorded size
+        and modification time, meaning it can be skipped without reading it.
+        """
+        entry = self.get(path)
+        if entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+            return entry
+        return None
+
+    def put(self, entry: ManifestEntry) -> None:
+        with self._lock:
+            self._entries[entry.path] = entry
+            self._dirty.add(entry.path)
+            should_flush = len(self._dirty) >= self.FLUSH_EVERY
+        if should_flush:
+            self.flush()
+
+    def get_folder(self, path: str) -> Optional[FolderManifestEntry]:
+        with self._lock:
+            return self._folders.get(path)
+
+    def put_folder(self, entry: FolderManifestEntry) -> None:
+        with self._lock:
+            self._folders[entry.path] = entry
+            self._dirty_folders.add(entry.path)
+
+    def get_token_count(self, encoding: str, checksum: str) -> Optional[int]:
+        with self._lock:
+            return self._token_counts.get((encoding, checksum))
+
+    def put_token_count(self, encoding: str, checksum: str, count: int) -> None:
+        with self._lock:
+            self._token_counts[(encoding, checksum)] = count
+            self._dirty_token_counts.add((encoding, checksum))
+
+    def get_chunk_summary(self, key: str) -> Optional[str]:
+        """
+        Chunk summaries can be large and most are never read again,
+        so they are looked up in the database instead of being preloaded
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT summary FROM chunk_summaries WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_chunk_summary(self, key: str, summary: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO chunk_summaries (key, summary) VALUES (?, ?)", (key, summary))
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: Optional[str]) -> None:
+        with self._lock, self._connection:
+            if value is None:
+                self._connection.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def merge(self, db_path: str, keep: Optional[Callable[[str], bool]] = None) -> None:
+        """
+        Copies the files and token counts of the manifest at db_path into
+        this one, replacing the entries of the same files. With keep, only
+        the files whose path it accepts are copied and chunk summaries are
+        not, otherwise chunk summaries are copied as well.
+        Folders are not copied, and the folders above files whose checksum
+        changed are forgotten, so they are summarized again instead of
+        being skipped as unchanged.
+        """
+        source = sqlite3.connect(db_path)
+        try:
+            files = [
+                ManifestEntry(*row)
+                for row in source.execute("SELECT path, size, mtime_ns, checksum, output_path FROM files")
+                if keep is None or keep(row[0])
+            ]
+            token_counts = source.execute("SELECT encoding, checksum, count FROM token_counts").fetchall()
+            with self._lock:
+                stale_folders = set()
+                for entry in files:
+                    existing = self._entries.get(entry.path)
+                    if existing is not None and existing.checksum != entry.checksum:
+                        folder = os.path.dirname(existing.output_path)
+                        while folder and folder not in stale_folders:
+                            stale_folders.add(folder)
+                            folder = os.path.dirname(folder)
+                    self._entries[entry.path] = entry
+                    self._dirty.add(entry.path)
+                stale_folders.intersection_update(self._folders)
+                for folder in stale_folders:
+                    del self._folders[folder]
+                    self._dirty_folders.discard(folder)
+                with self._connection:
+                    self._connection.executemany(
+                        "DELETE FROM folders WHERE path = ?", ((folder,) for folder in stale_folders)
+                    )
+                for encoding, checksum, count in token_counts:
+                    self._token_counts[(encoding, checksum)] = count
+                    self._dirty_token_counts.add((encoding, checksum))
+                if keep is None:
+                    with self._connection:
+                        self._connection.executemany(
+                            "INSERT OR REPLACE INTO chunk_summaries (key, summary) VALUES (?, ?)",
+                            source.execute("SELECT key, summary FROM chunk_summaries"),
+                        )
+        finally:
+            source.close()
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            rows = [astuple(self._entries[path]) for path in self._dirty]
+            folder_rows = [astuple(self._folders[path]) for path in self._dirty_folders]
+            token_count_rows = [(*key, self._token_counts[key]) for key in self._dirty_token_counts]
+            self._dirty.clear()
+            self._dirty_folders.clear()
+            self._dirty_token_counts.clear()
+            if rows or folder_rows or token_count_rows:
+                with self._connection:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO files (path, size, mtime_ns, checksum, output_path) VALUES (?, ?, ?, ?, ?)",
+                        rows,
+                    )
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO folders (path, checksum, listing) VALUES (?, ?, ?)",
+                        folder_rows,
+                    )
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO token_counts (encoding, checksum, count) VALUES (?, ?, ?)",
+                        token_count_rows,
+                    )
+
+    def close(self) -> None:
+        self.flush()
+        self._connection.close()
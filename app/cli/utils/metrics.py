@@ -0,0 +1,206 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, ContextManager, Dict, Iterator, List, Tuple
+
+from .llm_util import model_cost
+from ...data_types import LLMModelDetails
+
+# Upper bounds in seconds of the latency histogram buckets, from fast
+# local stages such as hashing up to slow LLM calls
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0, 300.0,
+)
+
+# Prefix of the metric names in the Prometheus text format
+PROMETHEUS_PREFIX = "autodoc_"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets, with their sum and maximum.
+    Quantiles are interpolated within the bucket they fall in,
+    as Prometheus does.
+    """
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count > 0 and cumulative + count >= rank:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - cumulative) / count)
+            cumulative += count
+        return self.max
+
+
+class Metrics:
+    """
+    Thread-safe counters and latency histograms of a run, by name and labels,
+    such as the seconds of each stage or the tokens used by each model.
+    The metrics used by indexing are:
+
+    - stage_seconds{stage}: walk, read, hash, tokenize, llm, write and embed
+    - llm_seconds{model}: each LLM call, without its wait in the rate limiter
+    - rate_limit_wait_seconds{model}: time calls were queued in the rate limiter
+    - llm_tokens{model, kind}: prompt and completion tokens reported by the provider
+    - llm_calls{model}, llm_cache_hits{model} and api_retries{model, reason}
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._started = time.time()
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Observes how long the block took, also when it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def stage(self, stage: str) -> ContextManager[None]:
+        return self.timer("stage_seconds", stage=stage)
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "mean": round(histogram.sum / histogram.count, 6) if histogram.count else 0.0,
+                    "p50": round(histogram.quantile(0.5), 6),
+                    "p90": round(histogram.quantile(0.9), 6),
+                    "p99": round(histogram.quantile(0.99), 6),
+                    "max": round(histogram.max, 6),
+                }
+                for (name, labels), histogram in sorted(self._histograms.items())
+            ]
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+        return {
+            "started": datetime.fromtimestamp(self._started, timezone.utc).isoformat(),
+            "seconds": round(time.time() - self._started, 3),
+            "histograms": histograms,
+            "counters": counters,
+        }
+
+    def prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format, with
+        cumulative buckets, for a node exporter textfile collector or
+        a push gateway
+        """
+        lines: List[str] = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+            typed = set()
+            for (name, labels), value in counters:
+                metric = f"{PROMETHEUS_PREFIX}{name}_total"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{format_labels(labels)} {value:g}")
+
+            for (name, labels), histogram in histograms:
+                metric = f"{PROMETHEUS_PREFIX}{name}"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{metric}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{metric}_sum{format_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{metric}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in escaped) + "}"
+
+
+def write_run_report(
+        path: str,
+        metrics: Metrics,
+        models: List[LLMModelDetails],
+        prometheus: bool = False,
+) -> None:
+    """
+    Writes the usage of each model and the metrics of the run as JSON to
+    path and, with prometheus, in the Prometheus text format next to it
+    """
+    report = {
+        "models": [
+            {
+                "name": model.name,
+                "calls": model.calls,
+                "input_tokens": model.input_tokens,
+                "output_tokens": model.output_tokens,
+                "cost": round(model_cost(model), 6),
+                "succeeded": model.succeeded,
+                "failed": model.failed,
+            }
+            for model in models
+        ],
+        **metrics.report(),
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=2))
+    if prometheus:
+        with open(os.path.splitext(path)[0] + ".prom", "w", encoding="utf-8") as f:
+            f.write(metrics.prometheus())
@@ -0,0 +1,103 @@
+import threading
+from typing import Callable, Dict, List, Optional
+
+from ...data_types import LLMModelDetails
+
+# Weight of the newest sample in the moving average of a model's latency
+LATENCY_SMOOTHING = 0.2
+
+
+class ModelRouter:
+    """
+    Picks a model for each request among the configured models
+    that can fit the prompt and the expected output.
+
+    Strategies:
+    - cheapest: the model with the lowest estimated cost
+    - fastest: the model with the lowest observed latency;
+      models without observations are tried first
+    - budget: the most expensive, and so most capable, model that
+      keeps the estimated spend within cost_budget
+
+    With a cost_budget, requests that would exceed it get no model.
+    A request reserves the estimated cost of all of its calls, so the
+    calls made after the first one are covered by the budget too.
+    """
+
+    STRATEGIES = ("cheapest", "fastest", "budget")
+
+    def __init__(
+            self,
+            models: List[LLMModelDetails],
+            strategy: str = "cheapest",
+            cost_budget: Optional[float] = None,
+            output_tokens: int = 1000,
+    ):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown model strategy: {strategy}")
+        if strategy == "budget" and cost_budget is None:
+            raise ValueError("The budget model strategy needs a cost_budget")
+        self._models = models
+        self._strategy = strategy
+        self._cost_budget = cost_budget
+        self._output_tokens = output_tokens
+        self._spent = 0.0
+        self._latencies: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def output_tokens(self) -> int:
+        return self._output_tokens
+
+    def fits_any(self, prompt_tokens: Callable[[str], int]) -> bool:
+        """
+        Whether any model can take the prompt at all, regardless of the budget
+        """
+        return any(
+            prompt_tokens(model.name) + self._output_tokens <= model.max_length
+            for model in self._models
+        )
+
+    def estimate_cost(self, model: LLMModelDetails, prompt_tokens: int, calls: int = 1) -> float:
+        return calls * (
+            prompt_tokens / 1000 * model.input_cost_per_1k_tokens
+            + self._output_tokens / 1000 * model.output_cost_per_1k_tokens
+        )
+
+    def select(self, prompt_tokens: Callable[[str], int], calls: int = 1) -> Optional[LLMModelDetails]:
+        """
+        prompt_tokens gives the length of the longest prompt of the request
+        for a model name, as models can use different encodings, and calls
+        the number of calls the request is expected to make.
+        The estimated cost of the chosen model is reserved against the budget.
+        """
+        fits = []
+        for model in self._models:
+            tokens = prompt_tokens(model.name)
+            if tokens + self._output_tokens <= model.max_length:
+                fits.append((model, self.estimate_cost(model, tokens, calls)))
+
+        with self._lock:
+            if self._cost_budget is not None:
+                remaining = self._cost_budget - self._spent
+                fits = [(model, cost) for model, cost in fits if cost <= remaining]
+            if not fits:
+                return None
+
+            if self._strategy == "fastest":
+                model, cost = min(fits, key=lambda fit: (self._latencies.get(fit[0].name, 0.0), fit[1]))
+            elif self._strategy == "budget":
+                model, cost = max(fits, key=lambda fit: fit[1])
+            else:
+                model, cost = min(fits, key=lambda fit: fit[1])
+
+            self._spent += cost
+            return model
+
+    def record_latency(self, model_name: str, seconds: float) -> None:
+        with self._lock:
+            previous = self._latencies.get(model_name)
+            self._latencies[model_name] = (
+                seconds if previous is None
+                else previous + LATENCY_SMOOTHING * (seconds - previous)
+            )
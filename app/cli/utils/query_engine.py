@@ -0,0 +1,147 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from .embeddings import Embedder
+from .vector_store import VectorStore, DEFAULT_NPROBE
+from ...data_types import SearchResult
+
+# Candidates fetched for each requested hit when reranking
+RERANK_CANDIDATES = 4
+
+# Weight of the share of the query words found in a chunk when reranking
+RERANK_WEIGHT = 0.3
+
+# Filters that leave at most this many chunks are searched exactly
+EXACT_FILTER_LIMIT = 50000
+
+# Source prefixes whose filters are kept in memory
+FILTER_CACHE_SIZE = 64
+
+Reranker = Callable[[str, List[SearchResult]], List[float]]
+
+# Mask of the chunk ids a filter keeps, their number, and their rows when few
+Filter = Tuple[NDArray[np.bool_], int, Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]]]
+
+
+def lexical_rerank(query: str, results: List[SearchResult]) -> List[float]:
+    """
+    Adds to the similarity of each hit the share of the query words it contains,
+    which favours chunks naming the identifiers the query asks about
+    """
+    words = set(re.findall(r"\w+", query.lower()))
+    if not words:
+        return [result.score for result in results]
+    return [
+        result.score
+        + RERANK_WEIGHT * len(words & set(re.findall(r"\w+", result.document.page_content.lower()))) / len(words)
+        for result in results
+    ]
+
+
+class QueryEngine:
+    """
+    Serves top-k searches over a persisted vector store, which is opened
+    once. Queries are embedded and searched in batches, and can be limited
+    to chunks whose source starts with a prefix: a filter that leaves few
+    chunks is searched exactly over them, otherwise the clusters are
+    searched with more probes and the other chunks masked out.
+    """
+
+    def __init__(self, path: str, embedder: Embedder, reranker: Reranker = lexical_rerank):
+        self.store = VectorStore(path, embedder)
+        self.embedder = embedder
+        self.reranker = reranker
+        self._filters: "OrderedDict[Tuple[str, int], Filter]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _filter(self, prefix: str) -> Filter:
+        """
+        Returns the mask of the chunk ids under prefix, their number, and
+        their rows when there are few enough of them to search exactly.
+        Filters are cached by the version of the store, as upserts add ids
+        and compactions move rows.
+        """
+        key = (prefix, self.store.version)
+        with self._lock:
+            if key in self._filters:
+                self._filters.move_to_end(key)
+                return self._filters[key]
+
+        ids = self.store.ids_with_source_prefix(prefix)
+        allowed = np.zeros(int(ids.max()) + 1 if len(ids) else 0, dtype=bool)
+        allowed[ids] = True
+        rows = self.store.rows(ids) if len(ids) <= EXACT_FILTER_LIMIT else None
+        entry = (allowed, len(ids), rows)
+
+        with self._lock:
+            self._filters[key] = entry
+            while len(self._filters) > FILTER_CACHE_SIZE:
+                self._filters.popitem(last=False)
+        return entry
+
+    def search_vectors(
+            self,
+            queries: NDArray[np.float32],
+            k: int = 4,
+            source_prefix: Optional[str] = None,
+            nprobe: int = DEFAULT_NPROBE,
+    ) -> List[Tuple[NDArray[np.int64], NDArray[np.float32]]]:
+        if not source_prefix:
+            return self.store.search_batch(queries, k, nprobe)
+
+        allowed, count, rows = self._filter(source_prefix)
+        if count == 0:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in queries]
+        if rows is not None:
+            return self.store.search_rows(queries, rows, k)
+
+        """
+        Probe more clusters the fewer chunks the filter keeps,
+        so about as many allowed chunks are scanned as without it
+        """
+        total = max(len(self.store.ids) + len(self.store.delta_ids), 1)
+        return self.store.search_batch(queries, k, int(np.ceil(nprobe * total / count)), allowed)
+
+    def search(
+            self,
+            queries: List[str],
+            k: int = 4,
+            source_prefix: Optional[str] = None,
+            rerank: bool = False,
+            nprobe: int = DEFAULT_NPROBE,
+    ) -> List[List[SearchResult]]:
+        """
+        Returns the k best chunks for each query, best first.
+        With rerank, more candidates are fetched and reordered by the reranker.
+        """
+        if not queries:
+            return []
+        candidates = k * RERANK_CANDIDATES if rerank else k
+        hits = self.search_vectors(self.embedder.embed(queries), candidates, source_prefix, nprobe)
+        documents = self.store.get_documents(sorted({int(i) for ids, _ in hits for i in ids}))
+
+        results = []
+        for query, (ids, scores) in zip(queries, hits):
+            query_results = [
+                SearchResult(id=int(i), score=float(score), document=documents[int(i)])
+                for i, score in zip(ids, scores)
+                if int(i) in documents
+            ]
+            if rerank and query_results:
+                reranked = self.reranker(query, query_results)
+                order = sorted(range(len(query_results)), key=lambda index: -reranked[index])
+                query_results = [
+                    SearchResult(id=query_results[index].id, score=reranked[index],
+                                 document=query_results[index].document)
+                    for index in order
+                ]
+            results.append(query_results[:k])
+        return results
+
+    def close(self) -> None:
+        self.store.close()
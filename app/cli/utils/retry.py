@@ -0,0 +1,34 @@
+import random
+
+# Backoff before the first retry of a failed call, doubled for every
+# further attempt up to MAX_DELAY_SECONDS
+BASE_DELAY_SECONDS = 1.0
+MAX_DELAY_SECONDS = 60.0
+
+# Rate limit errors are retried more times and after longer delays, as
+# they only mean the call has to wait for the quota of its model
+RATE_LIMIT_ATTEMPTS = 10
+RATE_LIMIT_BASE_DELAY_SECONDS = 5.0
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """
+    Recognizes the rate limit errors of the OpenAI client, or any other
+    client that reports an HTTP 429, without importing them
+    """
+    if type(error).__name__ == "RateLimitError":
+        return True
+    if getattr(error, "http_status", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    message = str(error).lower()
+    return "rate limit" in message or "rate_limit" in message
+
+
+def backoff_delay(attempt: int, rate_limited: bool = False) -> float:
+    """
+    Exponential backoff with full jitter: a random delay up to the
+    backoff of the attempt, which starts at 1, so calls that failed
+    together do not all retry at the same moment
+    """
+    base = RATE_LIMIT_BASE_DELAY_SECONDS if rate_limited else BASE_DELAY_SECONDS
+    return random.uniform(0, min(MAX_DELAY_SECONDS, base * 2 ** (attempt - 1)))
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, astuple
+from typing import Callable, Dict, List, Optional, Set
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class JournalEntry:
+    path: str
+    kind: str
+    state: str
+    changed: bool
+    attempts: int
+    error: Optional[str]
+    seconds: float
+
+
+class RunJournal:
+    """
+    Persistent record of the file and folder tasks of an indexing run:
+    whether each is pending, running, done or failed, whether it wrote a
+    new summary, how many times it was started, its last error and how
+    long its last attempt took.
+    A resumed run reuses the results of the tasks that are done and runs
+    everything else again; a new run starts with an empty journal.
+    Changes are kept in memory until flush, which saves the results of
+    the tasks before recording them as done, so no task is ever recorded
+    as done without its result on disk.
+    """
+
+    FLUSH_EVERY = 500
+    FLUSH_INTERVAL_SECONDS = 5.0
+
+    def __init__(self, db_path: str):
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                path TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                state TEXT NOT NULL,
+                changed INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                error TEXT
+            )
+        """)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(tasks)")]
+        if "seconds" not in columns:
+            self._connection.execute("ALTER TABLE tasks ADD COLUMN seconds REAL NOT NULL DEFAULT 0")
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._entries: Dict[str, JournalEntry] = {
+            row[0]: JournalEntry(row[0], row[1], row[2], bool(row[3]), row[4], row[5], row[6])
+            for row in self._connection.execute(
+                "SELECT path, kind, state, changed, attempts, error, seconds FROM tasks"
+            )
+        }
+        self._dirty: Set[str] = set()
+        self._resumed: Dict[str, bool] = {}
+        self._flushed = time.monotonic()
+
+    def start(self, resume: bool) -> None:
+        """
+        When resuming, the tasks that are done keep their results,
+        otherwise the journal of the previous run is cleared
+        """
+        with self._lock:
+            if resume:
+                self._resumed = {
+                    entry.path: entry.changed for entry in self._entries.values() if entry.state == DONE
+                }
+                return
+            self._resumed = {}
+            self._entries.clear()
+            self._dirty.clear()
+            with self._connection:
+                self._connection.execute("DELETE FROM tasks")
+
+    def resumed_result(self, path: str) -> Optional[bool]:
+        """
+        Whether the task wrote a new summary, if it was done
+        in the run that is being resumed
+        """
+        with self._lock:
+            return self._resumed.get(path)
+
+    def _set(
+            self,
+            path: str,
+            kind: str,
+            state: str,
+            changed: bool = False,
+            error: Optional[str] = None,
+            seconds: float = 0.0,
+    ) -> bool:
+        with self._lock:
+            entry = self._entries.get(path)
+            attempts = entry.attempts if entry is not None else 0
+            if state == RUNNING:
+                attempts += 1
+            self._entries[path] = JournalEntry(path, kind, state, changed, attempts, error, seconds)
+            self._dirty.add(path)
+            return len(self._dirty) >= self.FLUSH_EVERY \
+                or time.monotonic() - self._flushed >= self.FLUSH_INTERVAL_SECONDS
+
+    def pending(self, path: str, kind: str) -> None:
+        """
+        Tasks that are done in the run being resumed keep their record
+        """
+        if self.resumed_result(path) is None:
+            self._set(path, kind, PENDING)
+
+    def running(self, path: str, kind: str) -> None:
+        self._set(path, kind, RUNNING)
+
+    def done(self, path: str, kind: str, changed: bool, seconds: float = 0.0) -> bool:
+        """
+        Returns whether the journal should be flushed, because enough
+        changes are buffered or the last flush was a while ago
+        """
+        return self._set(path, kind, DONE, changed, seconds=seconds)
+
+    def failed(self, path: str, kind: str, error: str, seconds: float = 0.0) -> bool:
+        return self._set(path, kind, FAILED, error=error, seconds=seconds)
+
+    def entries(self, state: Optional[str] = None) -> List[JournalEntry]:
+        with self._lock:
+            return [entry for entry in self._entries.values() if state is None or entry.state == state]
+
+    def counts(self) -> Dict[str, int]:
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for entry in self.entries():
+            counts[entry.state] += 1
+        return counts
+
+    def flush(self, save_results: Callable[[], None] = lambda: None) -> None:
+        """
+        Takes the changes made so far, calls save_results to persist the
+        results of the tasks they mark as done, then writes the changes
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows = [astuple(self._entries[path]) for path in self._dirty]
+                self._dirty.clear()
+                self._flushed = time.monotonic()
+            save_results()
+            if rows:
+                with self._lock, self._connection:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO tasks (path, kind, state, changed, attempts, error, seconds) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        rows,
+                    )
+
+    def close(self, save_results: Callable[[], None] = lambda: None) -> None:
+        self.flush(save_results)
+        with self._lock:
+            self._connection.close()
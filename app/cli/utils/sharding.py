@@ -0,0 +1,118 @@
+import dataclasses
+import hashlib
+import math
+import os
+import sys
+from typing import Callable, List, Optional
+
+from .manifest import Manifest
+from .run_journal import RunJournal, FAILED
+from .summary_store import SummaryStore
+from ...data_types import AutodocRepoConfig
+
+# Folder of the output where each shard keeps its own stores
+SHARDS_FOLDER = "shards"
+
+
+def shard_of(relative_path: str, shards: int) -> int:
+    """
+    The shard of a file by the hash of its path in the repository, which
+    unlike hash() is the same in every process and on every machine
+    """
+    digest = hashlib.md5(relative_path.replace(os.sep, "/").encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % shards
+
+
+def shard_filter(input_root: str, shard: int, shards: int) -> Callable[[str], bool]:
+    """
+    Returns whether a file path under input_root belongs to the shard
+    """
+    def in_shard(file_path: str) -> bool:
+        return shard_of(os.path.relpath(file_path, input_root), shards) == shard
+
+    return in_shard
+
+
+def shard_root(output_root: str, shard: int, shards: int) -> str:
+    return os.path.join(output_root, SHARDS_FOLDER, f"{shard}-of-{shards}")
+
+
+def check_shards(config: AutodocRepoConfig) -> None:
+    if config.shards < 1:
+        raise ValueError(f"shards must be at least 1, got {config.shards}")
+    if config.shard is not None and not 0 <= config.shard < config.shards:
+        raise ValueError(f"shard must be between 0 and {config.shards - 1}, got {config.shard}")
+
+
+def shard_config(config: AutodocRepoConfig) -> AutodocRepoConfig:
+    """
+    The shards run at the same time against the same API keys, so each
+    gets an equal slice of the concurrent calls and of the requests and
+    tokens per minute of every model
+    """
+    def share(limit: Optional[int]) -> Optional[int]:
+        return max(1, limit // config.shards) if limit else limit
+
+    return dataclasses.replace(
+        config,
+        max_concurrent_calls=max(1, math.ceil(config.max_concurrent_calls / config.shards)),
+        rate_limits={
+            model: dataclasses.replace(
+                limits,
+                requests_per_minute=share(limits.requests_per_minute),
+                tokens_per_minute=share(limits.tokens_per_minute),
+            )
+            for model, limits in config.rate_limits.items()
+        },
+    )
+
+
+def seed_shard(output_root: str, state_root: str, keep: Callable[[str], bool]) -> None:
+    """
+    Starts the stores of a shard over from the merged stores, with only
+    the files of the shard, so it summarizes what changed since the last
+    merge and nothing else. Chunk summaries are not copied, the response
+    cache answers the chunks that did not change.
+    """
+    for name in ("manifest.sqlite", "summaries.sqlite"):
+        path = os.path.join(state_root, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    manifest = Manifest(os.path.join(state_root, "manifest.sqlite"))
+    summary_store = SummaryStore(os.path.join(state_root, "summaries.sqlite"))
+    if os.path.exists(os.path.join(output_root, "manifest.sqlite")):
+        manifest.merge(os.path.join(output_root, "manifest.sqlite"), keep)
+    if os.path.exists(os.path.join(output_root, "summaries.sqlite")):
+        summary_store.merge(os.path.join(output_root, "summaries.sqlite"), keep)
+    summary_store.close()
+    manifest.close()
+
+
+def merge_shards(output_root: str, shards: int) -> List[int]:
+    """
+    Merges the file summaries and manifests of the shards into the stores
+    in output_root, so a run there only has the folders left to summarize.
+    The files that failed in a shard are summarized again by that run.
+    Returns the shards that were merged.
+    """
+    manifest = Manifest(os.path.join(output_root, "manifest.sqlite"))
+    summary_store = SummaryStore(os.path.join(output_root, "summaries.sqlite"))
+    merged = []
+    for shard in range(shards):
+        state_root = shard_root(output_root, shard, shards)
+        if not os.path.exists(os.path.join(state_root, "summaries.sqlite")):
+            print(f"Shard {shard} of {shards} has no results to merge", file=sys.stderr)
+            continue
+        summary_store.merge(os.path.join(state_root, "summaries.sqlite"))
+        manifest.merge(os.path.join(state_root, "manifest.sqlite"))
+        merged.append(shard)
+
+        journal = RunJournal(os.path.join(state_root, "journal.sqlite"))
+        failed = journal.counts()[FAILED]
+        journal.close()
+        if failed > 0:
+            print(f"{failed} files failed in shard {shard} of {shards}", file=sys.stderr)
+    summary_store.close()
+    manifest.close()
+    return merged
@@ -0,0 +1,244 @@
+import dataclasses
+import json
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from ...data_types import FileSummary, FolderSummary
+
+Summary = Union[FileSummary, FolderSummary]
+
+
+class SummaryStore:
+    """
+    Every file and folder summary of a repository in a single SQLite
+    database, keyed by the path the summary would have as a JSON file
+    (`<folder>/<file>.json` and `<folder>/summary.json`).
+    A folder refers to its children by id instead of embedding copies of
+    them, so each summary is stored once, and any summary can be read on
+    its own. The path and checksum of every summary are loaded on open so
+    checking whether a summary is current never touches the disk; changes
+    are committed in batches.
+    export_json writes the one-file-per-summary JSON layout of earlier
+    versions, with folders embedding their children.
+    """
+
+    FLUSH_EVERY = 500
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                source_path TEXT NOT NULL,
+                url TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                questions TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                file_ids TEXT NOT NULL,
+                folder_ids TEXT NOT NULL
+            )
+        """)
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._entries: Dict[str, Tuple[int, str]] = {
+            row[0]: (row[1], row[2])
+            for row in self._connection.execute("SELECT path, id, checksum FROM summaries")
+        }
+
+    def has(self, path: str) -> bool:
+        with self._lock:
+            return path in self._entries
+
+    def checksum(self, path: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(path)
+        return entry[1] if entry is not None else None
+
+    def _put(
+            self,
+            path: str,
+            kind: str,
+            name: str,
+            summary: Summary,
+            file_ids: List[int],
+            folder_ids: List[int],
+    ) -> int:
+        source_path = summary.file_path if isinstance(summary, FileSummary) else summary.folder_path
+        self._connection.execute(
+            """
+            INSERT INTO summaries
+                (path, kind, name, source_path, url, summary, questions, checksum, file_ids, folder_ids)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                kind = excluded.kind,
+                name = excluded.name,
+                source_path = excluded.source_path,
+                url = excluded.url,
+                summary = excluded.summary,
+                questions = excluded.questions,
+                checksum = excluded.checksum,
+                file_ids = excluded.file_ids,
+                folder_ids = excluded.folder_ids
+            """,
+            (path, kind, name, source_path, summary.url, summary.summary, summary.questions,
+             summary.checksum, json.dumps(file_ids), json.dumps(folder_ids)),
+        )
+        row = self._connection.execute("SELECT id FROM summaries WHERE path = ?", (path,)).fetchone()
+        self._entries[path] = (row[0], summary.checksum)
+        self._pending += 1
+        if self._pending >= self.FLUSH_EVERY:
+            self._connection.commit()
+            self._pending = 0
+        return int(row[0])
+
+    def paths(self) -> List[str]:
+        with self._lock:
+            return list(self._entries)
+
+    def delete(self, paths: List[str]) -> None:
+        """
+        Removes the summaries at paths. Folders that referred to them
+        are summarized again, as their listing changed.
+        """
+        with self._lock:
+            self._connection.executemany("DELETE FROM summaries WHERE path = ?", ((path,) for path in paths))
+            self._connection.commit()
+            self._pending = 0
+            for path in paths:
+                self._entries.pop(path, None)
+
+    def put_file(self, path: str, summary: FileSummary) -> int:
+        with self._lock:
+            return self._put(path, "file", summary.file_name, summary, [], [])
+
+    def put_folder(
+            self,
+            path: str,
+            summary: FolderSummary,
+            file_paths: List[str],
+            folder_paths: List[str],
+    ) -> int:
+        """
+        The children are given by the paths of their summaries,
+        which must already be stored
+        """
+        with self._lock:
+            file_ids = [self._entries[child][0] for child in file_paths if child in self._entries]
+            folder_ids = [self._entries[child][0] for child in folder_paths if child in self._entries]
+            return self._put(path, "folder", summary.folder_name, summary, file_ids, folder_ids)
+
+    @staticmethod
+    def _summary(
+            kind: str,
+            name: str,
+            source_path: str,
+            url: str,
+            summary: str,
+            questions: str,
+            checksum: str,
+    ) -> Summary:
+        """
+        Folders are returned without their children, see load_tree
+        """
+        if kind == "file":
+            return FileSummary(name, source_path, url, summary, questions, checksum)
+        return FolderSummary(name, source_path, url, [], [], summary, questions, checksum)
+
+    def get_many(self, paths: List[str]) -> Dict[str, Summary]:
+        summaries = {}
+        with self._lock:
+            for start in range(0, len(paths), 500):
+                batch = paths[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT path, kind, name, source_path, url, summary, questions, checksum "
+                    f"FROM summaries WHERE path IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for row in rows:
+                    summaries[row[0]] = self._summary(*row[1:])
+        return summaries
+
+    def get(self, path: str) -> Optional[Summary]:
+        return self.get_many([path]).get(path)
+
+    def items(self, batch_size: int = 1000) -> Iterator[List[Tuple[str, Summary]]]:
+        """
+        Yields every summary with its path, batch_size at a time
+        """
+        with self._lock:
+            paths = sorted(self._entries)
+        for start in range(0, len(paths), batch_size):
+            batch = paths[start:start + batch_size]
+            summaries = self.get_many(batch)
+            yield [(path, summaries[path]) for path in batch if path in summaries]
+
+    def _trees(self) -> Dict[str, Summary]:
+        """
+        Every summary with all of its descendants, by path
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, path, kind, name, source_path, url, summary, questions, checksum, file_ids, folder_ids "
+                "FROM summaries"
+            ).fetchall()
+        summaries = {row[0]: self._summary(*row[2:9]) for row in rows}
+        for row in rows:
+            summary = summaries[row[0]]
+            if isinstance(summary, FolderSummary):
+                summary.files = [summaries[i] for i in json.loads(row[9]) if i in summaries]  # type: ignore[misc]
+                summary.folders = [summaries[i] for i in json.loads(row[10]) if i in summaries]  # type: ignore[misc]
+        return {row[1]: summaries[row[0]] for row in rows}
+
+    def load_tree(self, path: str) -> Optional[Summary]:
+        """
+        Returns a summary with all of its descendants, as in the JSON layout
+        """
+        return self._trees().get(path)
+
+    def export_json(self) -> None:
+        """
+        Writes every summary as a JSON file at its path
+        """
+        for path, summary in self._trees().items():
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(dataclasses.asdict(summary), indent=2) if len(summary.summary) > 0 else "")
+
+    def merge(self, db_path: str, keep: Optional[Callable[[str], bool]] = None) -> None:
+        """
+        Copies the file summaries of the store at db_path into this one,
+        replacing the summaries at the same paths, and with keep only those
+        whose source file it accepts. Folder summaries are not copied,
+        as the ids of their children only mean something in their own store.
+        """
+        source = sqlite3.connect(db_path)
+        try:
+            rows = source.execute(
+                "SELECT path, kind, name, source_path, url, summary, questions, checksum "
+                "FROM summaries WHERE kind = 'file'"
+            )
+            with self._lock:
+                for row in rows:
+                    if keep is None or keep(row[3]):
+                        self._put(row[0], "file", row[2], self._summary(*row[1:]), [], [])
+                self._connection.commit()
+                self._pending = 0
+        finally:
+            source.close()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,60 @@
+import threading
+from concurrent.futures import Future, wait
+from typing import Any, Callable, List, Sequence, TypeVar
+
+from .task_pool import TaskPool
+
+T = TypeVar('T')
+
+
+class TaskGraph:
+    """
+    Schedules tasks on a `TaskPool` once all of their dependencies are
+    done, so independent parts of the graph run in parallel and nothing
+    waits on work it does not depend on.
+    A failed dependency still counts as done; tasks decide for themselves
+    what to do about missing inputs.
+    """
+
+    def __init__(self, task_pool: TaskPool):
+        self._task_pool = task_pool
+        self._futures: "List[Future[Any]]" = []
+
+    def add(
+            self,
+            fn: Callable[[], T],
+            dependencies: Sequence["Future[Any]"],
+    ) -> "Future[T]":
+        result: "Future[T]" = Future()
+        self._futures.append(result)
+        remaining = len(dependencies)
+        lock = threading.Lock()
+
+        def start() -> None:
+            future = self._task_pool.submit(fn)
+            future.add_done_callback(lambda done: _copy_result(done, result))
+
+        def on_dependency_done(_: "Future[Any]") -> None:
+            nonlocal remaining
+            with lock:
+                remaining -= 1
+                ready = remaining == 0
+            if ready:
+                start()
+
+        if remaining == 0:
+            start()
+        for dependency in dependencies:
+            dependency.add_done_callback(on_dependency_done)
+        return result
+
+    def join(self) -> None:
+        wait(self._futures)
+
+
+def _copy_result(source: "Future[T]", target: "Future[T]") -> None:
+    exception = source.exception()
+    if exception is not None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result())
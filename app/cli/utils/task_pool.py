@@ -0,0 +1,104 @@
+import abc
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class TaskPool(abc.ABC):
+    """
+    Runs tasks on a fixed number of workers and keeps track of the
+    futures so `join` can wait for everything that was submitted.
+    """
+
+    def __init__(self, max_workers: int):
+        self._max_workers = max_workers
+        self._futures: List["Future[object]"] = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[[], T]) -> "Future[T]":
+        future = self._submit(fn)
+        with self._lock:
+            self._futures.append(future)  # type: ignore[arg-type]
+        return future
+
+    def join(self) -> None:
+        """
+        Waits until all submitted tasks are done, including
+        tasks submitted by other tasks while waiting.
+        """
+        while True:
+            with self._lock:
+                futures, self._futures = self._futures, []
+            if not futures:
+                return
+            wait(futures)
+
+    @abc.abstractmethod
+    def shutdown(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def _submit(self, fn: Callable[[], T]) -> "Future[T]":
+        ...
+
+    def __enter__(self) -> "TaskPool":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.join()
+        self.shutdown()
+
+
+class ThreadTaskPool(TaskPool):
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _submit(self, fn: Callable[[], T]) -> "Future[T]":
+        return self._executor.submit(fn)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+class AsyncioTaskPool(TaskPool):
+    """
+    Runs tasks on an event loop in a background thread. At most
+    `max_workers` tasks run at once; blocking work is moved off the
+    loop with `asyncio.to_thread`.
+    """
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def _run(self, fn: Callable[[], T]) -> T:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_workers)
+        async with self._semaphore:
+            return await asyncio.to_thread(fn)
+
+    def _submit(self, fn: Callable[[], T]) -> "Future[T]":
+        return asyncio.run_coroutine_threadsafe(self._run(fn), self._loop)
+
+    def shutdown(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown()
+
+
+def create_task_pool(backend: str, max_workers: int) -> TaskPool:
+    if backend == "thread":
+        return ThreadTaskPool(max_workers)
+    if backend == "asyncio":
+        return AsyncioTaskPool(max_workers)
+    raise ValueError(f"Unknown concurrency backend: {backend}")
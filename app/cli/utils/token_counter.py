@@ -0,0 +1,119 @@
+import math
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+from tiktoken import Encoding, encoding_for_model, get_encoding
+
+from .manifest import Manifest
+from .metrics import Metrics
+
+
+class TokenCounter:
+    """
+    Counts prompt tokens with the right TikToken encoding for each model.
+    A prompt is counted as the tokens of its template without the file
+    contents plus the tokens of the contents, so file contents are only
+    tokenized once per encoding and the counts are kept in the manifest
+    by content checksum across runs.
+    The time spent encoding goes to the tokenize stage of metrics.
+    """
+
+    def __init__(self, manifest: Optional[Manifest] = None, metrics: Optional[Metrics] = None):
+        self._manifest = manifest
+        self._metrics = metrics or Metrics()
+        self._encodings: Dict[str, Encoding] = {}
+        self._template_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def encoding(self, model_name: str) -> Encoding:
+        with self._lock:
+            if model_name not in self._encodings:
+                try:
+                    self._encodings[model_name] = encoding_for_model(model_name)
+                except KeyError:
+                    self._encodings[model_name] = get_encoding("cl100k_base")
+            return self._encodings[model_name]
+
+    def count(self, model_name: str, text: str) -> int:
+        """
+        Special tokens such as <|endoftext|> in the text are counted
+        as plain text instead of raising, as they can appear in files
+        """
+        encoding = self.encoding(model_name)
+        with self._metrics.stage("tokenize"):
+            return len(encoding.encode(text, disallowed_special=()))
+
+    def count_content(self, model_name: str, checksum: str, text: str) -> int:
+        encoding = self.encoding(model_name).name
+        if self._manifest is not None:
+            cached = self._manifest.get_token_count(encoding, checksum)
+            if cached is not None:
+                return cached
+        count = self.count(model_name, text)
+        if self._manifest is not None:
+            self._manifest.put_token_count(encoding, checksum, count)
+        return count
+
+    def count_template(self, model_name: str, template: str) -> int:
+        """
+        Counts a prompt rendered without its contents. Most files share
+        the same template, so these counts are cached in memory.
+        """
+        key = f"{self.encoding(model_name).name}\0{template}"
+        with self._lock:
+            cached = self._template_counts.get(key)
+        if cached is None:
+            cached = self.count(model_name, template)
+            with self._lock:
+                self._template_counts[key] = cached
+        return cached
+
+    def count_prompt(self, model_name: str, template: str, checksum: str, contents: str) -> int:
+        return self.count_template(model_name, template) + self.count_content(model_name, checksum, contents)
+
+    def split(self, model_name: str, text: str, max_tokens: int) -> List[str]:
+        """
+        Splits text into chunks of at most max_tokens tokens between lines.
+        Chunks end after lines whose hash, together with the previous line,
+        marks them as a boundary, so boundaries depend on the content around
+        them rather than on their offset: an edit only changes the chunks
+        around it and later chunks keep their contents and cached summaries.
+        The boundary rate is picked so chunks are about half of max_tokens.
+        A line that is too long on its own is split by tokens.
+        """
+        encoding = self.encoding(model_name)
+        lines = text.splitlines(keepends=True)
+        with self._metrics.stage("tokenize"):
+            line_tokens = [encoding.encode(line, disallowed_special=()) for line in lines]
+        total_tokens = sum(len(tokens) for tokens in line_tokens)
+        if total_tokens <= max_tokens:
+            return [text] if text else []
+
+        lines_per_chunk = max_tokens / 2 / max(1.0, total_tokens / len(lines))
+        modulus = 2 ** max(0, round(math.log2(max(1.0, lines_per_chunk))))
+        min_tokens = max_tokens // 8
+
+        chunks: List[str] = []
+        current: List[str] = []
+        current_tokens = 0
+        previous = ""
+        for line, tokens in zip(lines, line_tokens):
+            if current and current_tokens + len(tokens) > max_tokens:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+            if len(tokens) > max_tokens:
+                for start in range(0, len(tokens), max_tokens):
+                    chunks.append(encoding.decode(tokens[start:start + max_tokens]))
+                previous = line
+                continue
+            current.append(line)
+            current_tokens += len(tokens)
+            boundary = zlib.crc32((previous + line).encode("utf-8")) % modulus == 0
+            previous = line
+            if boundary and current_tokens >= min_tokens:
+                chunks.append("".join(current))
+                current, current_tokens = [], 0
+        if current:
+            chunks.append("".join(current))
+        return chunks
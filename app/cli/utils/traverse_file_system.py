@@ -1,9 +1,45 @@
+import codecs
+import hashlib
+import mmap
 import os
 import sys
-from fnmatch import fnmatch
-from typing import AnyStr
-
-from ...data_types import TraverseFileSystemParams, ProcessFolderParams, ProcessFileParams
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from .ignore_matcher import IgnoreMatcher
+from .metrics import Metrics
+from ...data_types import TraverseFileSystemParams, ProcessFolderParams, ProcessFileParams, FileRecord
+
+# Only this many leading bytes are inspected to tell text from binary files
+SNIFF_SIZE = 8192
+
+# Files at least this large are memory-mapped instead of read into a buffer
+MMAP_THRESHOLD = 256 * 1024
+
+
+def scan_directory(
+        current_path: str,
+        relative_path: str,
+        matcher: IgnoreMatcher,
+) -> Tuple[List[str], List[str]]:
+    """
+    Lists a directory once with os.scandir and returns the names of
+    the folders and files in it that are not ignored.
+    Ignored folders are dropped here, so they are never descended into.
+    """
+    folders: List[str] = []
+    files: List[str] = []
+    with os.scandir(current_path) as entries:
+        for entry in entries:
+            entry_path = f"{relative_path}/{entry.name}" if relative_path else entry.name
+            if entry.is_dir():
+                if not matcher.ignored(entry_path, is_dir=True):
+                    folders.append(entry.name)
+            elif entry.is_file():
+                if not matcher.ignored(entry_path):
+                    files.append(entry.name)
+    return sorted(folders), sorted(files)
 
 
 def traverse_file_system(
@@ -20,70 +56,180 @@ def traverse_file_system(
         content_type = params.content_type
         target_audience = params.target_audience
         link_hosted = params.link_hosted
+        scan_workers = params.scan_workers
 
         if not os.access(input_path, mode=os.F_OK):
             print("The provided folder path does not exist.")
             return
 
-        def should_ignore(file_name: str) -> bool:
-            return any(fnmatch(file_name, pattern) for pattern in ignore)
-
-        def dfs(current_path: str) -> None:
-            contents = [
-                file_name
-                for file_name in os.listdir(current_path)
-                if not should_ignore(file_name)
-            ]
-
-            for folder_name in contents:
+        matcher = IgnoreMatcher(ignore)
+        executor = ThreadPoolExecutor(max_workers=scan_workers) if scan_workers > 0 else None
+
+        def scan(current_path: str, relative_path: str) -> "Future[Tuple[List[str], List[str]]]":
+            """
+            With scan_workers, directories are listed ahead of the walk on
+            a thread pool, which hides latency on network file systems.
+            The walk itself still visits everything in the same order.
+            """
+            if executor is not None:
+                return executor.submit(scan_directory, current_path, relative_path, matcher)
+            future: "Future[Tuple[List[str], List[str]]]" = Future()
+            future.set_result(scan_directory(current_path, relative_path, matcher))
+            return future
+
+        def dfs(current_path: str, relative_path: str, listing: "Future[Tuple[List[str], List[str]]]") -> None:
+            folder_names, file_names = listing.result()
+
+            subfolders = []
+            for folder_name in folder_names:
                 folder_path = os.path.join(current_path, folder_name)
+                folder_relative_path = f"{relative_path}/{folder_name}" if relative_path else folder_name
+                subfolders.append((folder_name, folder_path, folder_relative_path))
+
+            """
+            Only list subfolders eagerly when a pool can do it in parallel
+            """
+            listings = [
+                scan(folder_path, folder_relative_path) if executor is not None else None
+                for _, folder_path, folder_relative_path in subfolders
+            ]
 
-                if os.path.isdir(folder_path):
-                    dfs(folder_path)
-
-                    if process_folder:
-                        process_folder(ProcessFolderParams(
-                            input_path=input_path,
-                            folder_name=folder_name,
-                            folder_path=folder_path,
-                            project_name=project_name,
-                            should_ignore=should_ignore,
-                            folder_prompt=folder_prompt,
-                            content_type=content_type,
-                            target_audience=target_audience,
-                            link_hosted=link_hosted,
-                        ))
-
-            for file_name in contents:
+            for (folder_name, folder_path, folder_relative_path), folder_listing in zip(subfolders, listings):
+                sub_listing = folder_listing or scan(folder_path, folder_relative_path)
+                dfs(folder_path, folder_relative_path, sub_listing)
+
+                if process_folder:
+                    sub_folder_names, sub_file_names = sub_listing.result()
+                    process_folder(ProcessFolderParams(
+                        input_path=input_path,
+                        folder_name=folder_name,
+                        folder_path=folder_path,
+                        project_name=project_name,
+                        should_ignore=matcher.should_ignore,
+                        folder_prompt=folder_prompt,
+                        content_type=content_type,
+                        target_audience=target_audience,
+                        link_hosted=link_hosted,
+                        folder_names=sub_folder_names,
+                        file_names=sub_file_names,
+                    ))
+
+            for file_name in file_names:
                 file_path = os.path.join(current_path, file_name)
 
-                if not os.path.isfile(file_path):
-                    continue
-
-                with open(file_path, "rb") as f:
-                    buffer = f.read()
-
-                if is_text(buffer):
-                    if process_file:
-                        process_file(ProcessFileParams(
-                            file_name=file_name,
-                            file_path=file_path,
-                            project_name=project_name,
-                            file_prompt=file_prompt,
-                            content_type=content_type,
-                            target_audience=target_audience,
-                            link_hosted=link_hosted,
-                        ))
-
-        dfs(input_path)
+                """
+                Files are not read here; process_file reads each one once
+                with read_file_record, which also skips binary files
+                """
+                if process_file:
+                    process_file(ProcessFileParams(
+                        file_name=file_name,
+                        file_path=file_path,
+                        project_name=project_name,
+                        file_prompt=file_prompt,
+                        content_type=content_type,
+                        target_audience=target_audience,
+                        link_hosted=link_hosted,
+                    ))
+
+        try:
+            dfs(input_path, "", scan(input_path, ""))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
     except Exception as e:
         print(f"Error during traversal: {e}", file=sys.stderr)
         raise e
 
 
-def is_text(buffer: AnyStr):
+def is_text(buffer: bytes) -> bool:
+    """
+    Checks whether a prefix of a file looks like UTF-8 text.
+    A multibyte character cut off at the end of the prefix is allowed.
+    """
+    if b"\x00" in buffer:
+        return False
     try:
-        buffer.decode("utf-8")
+        codecs.getincrementaldecoder("utf-8")().decode(buffer, final=False)
         return True
     except UnicodeDecodeError:
         return False
+
+
+def normalize_newlines(content: bytes) -> bytes:
+    """
+    Turns \r\n and \r into \n, as reading in text mode does, so
+    contents and checksums match those of files read as text
+    """
+    if b"\r" not in content:
+        return content
+    return content.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+def file_checksum(buffer: bytes) -> str:
+    """
+    Same value as calculate_checksum([buffer.decode("utf-8")])
+    without decoding and re-encoding the content
+    """
+    return hashlib.md5(hashlib.md5(buffer).hexdigest().encode("utf-8")).hexdigest()
+
+
+def read_file_record(
+        file_path: str,
+        max_file_size: Optional[int] = None,
+        metrics: Optional[Metrics] = None,
+) -> Optional[FileRecord]:
+    """
+    Reads a file once and returns its text and checksum,
+    or None if it is binary or larger than max_file_size.
+    Binary files are rejected after reading only a short prefix,
+    and large files are memory-mapped so they are never copied
+    into an intermediate buffer.
+    The time spent hashing goes to the hash stage of metrics
+    and the rest to the read stage.
+    """
+    start = time.perf_counter()
+    hash_seconds = 0.0
+    with open(file_path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if max_file_size is not None and stat.st_size > max_file_size:
+            return None
+
+        try:
+            if stat.st_size >= MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    if not is_text(buffer[:SNIFF_SIZE]):
+                        return None
+                    if buffer.find(b"\r") != -1:
+                        content = normalize_newlines(buffer[:])
+                        hash_start = time.perf_counter()
+                        checksum = file_checksum(content)
+                        hash_seconds = time.perf_counter() - hash_start
+                        text = content.decode("utf-8")
+                    else:
+                        hash_start = time.perf_counter()
+                        checksum = file_checksum(buffer)  # type: ignore[arg-type]
+                        hash_seconds = time.perf_counter() - hash_start
+                        text = str(buffer, "utf-8")
+            else:
+                content = f.read()
+                if not is_text(content[:SNIFF_SIZE]):
+                    return None
+                content = normalize_newlines(content)
+                hash_start = time.perf_counter()
+                checksum = file_checksum(content)
+                hash_seconds = time.perf_counter() - hash_start
+                text = content.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+
+    if metrics is not None:
+        metrics.observe("stage_seconds", hash_seconds, stage="hash")
+        metrics.observe("stage_seconds", time.perf_counter() - start - hash_seconds, stage="read")
+    return FileRecord(
+        file_path=file_path,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        text=text,
+        checksum=checksum,
+    )
@@ -0,0 +1,515 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple, Any
+
+import numpy as np
+from langchain.schema import Document
+from numpy.typing import NDArray
+
+from .embedding_cache import text_checksum
+from .embeddings import Embedder, normalize
+
+# Number of inverted lists searched for each query by default
+DEFAULT_NPROBE = 16
+
+# Points sampled for each inverted list to train the centroids
+TRAINING_POINTS_PER_LIST = 256
+
+KMEANS_ITERATIONS = 10
+
+# Share of the main segment that the delta and the tombstones
+# can reach before the index should be compacted
+COMPACTION_RATIO = 0.2
+
+
+def kmeans(vectors: NDArray[np.float32], nlist: int, seed: int = 0) -> NDArray[np.float32]:
+    """
+    Spherical k-means on a sample of unit vectors, so the centroids are
+    unit vectors too and the nearest centroid is the one with the highest
+    dot product. Seeded, so the same vectors always give the same index.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * TRAINING_POINTS_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    centroids: NDArray[np.float32] = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        lists = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        counts = np.bincount(lists, minlength=nlist)
+        empty = counts == 0
+        centroids[~empty] = normalize(sums[~empty])
+        if empty.any():
+            centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_lists(
+        vectors: NDArray[np.float32],
+        centroids: NDArray[np.float32],
+        batch_size: int = 65536,
+) -> NDArray[np.int64]:
+    lists = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        lists[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+    return lists
+
+
+def top_k(scores: NDArray[np.float32], k: int) -> NDArray[np.int64]:
+    """
+    Indexes of the k highest scores, highest first
+    """
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def save_array(path: str, array: NDArray[Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def best_hits(
+        score_parts: List[NDArray[np.float32]],
+        id_parts: List[NDArray[np.int64]],
+        k: int,
+        dead: NDArray[np.bool_],
+        allowed: Optional[NDArray[np.bool_]],
+) -> Tuple[NDArray[np.int64], NDArray[np.float32]]:
+    """
+    The k best of the scored candidates that are not dead and are allowed.
+    Ids past the end of allowed were added after it was made and are not allowed.
+    """
+    if not score_parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    scores = np.concatenate(score_parts)
+    candidates = np.concatenate(id_parts)
+    hidden = dead[candidates]
+    if allowed is not None:
+        hidden |= candidates >= len(allowed)
+        hidden |= ~allowed[np.minimum(candidates, len(allowed) - 1)] if len(allowed) else True
+    scores[hidden] = -np.inf
+    best = top_k(scores, k)
+    best = best[np.isfinite(scores[best])]
+    return candidates[best], scores[best]
+
+
+def read_raw(path: str, dtype: "np.dtype[Any]", shape: Tuple[int, ...]) -> NDArray[Any]:
+    """
+    Maps the first shape[0] rows of a raw array file, which may be empty
+    """
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+class VectorStore:
+    """
+    Inverted file (IVF) index over unit vectors with cosine similarity,
+    updated in place by source file.
+
+    The main segment clusters the vectors around nlist centroids and stores
+    them grouped by cluster, so a query only scores the vectors of the
+    nprobe clusters whose centroids are closest to it. Chunks added since
+    the last compaction are appended to a delta segment that every query
+    scans in full. Replaced and deleted chunks are tombstoned: their
+    vectors stay in the segments but are never returned. Once the delta and
+    the tombstones grow past COMPACTION_RATIO of the main segment, a
+    compaction writes a new main segment from the live vectors and becomes
+    visible by switching generation. Upserts and queries from other
+    threads go on while it runs.
+
+    An index is a folder of arrays opened memory-mapped, so loading it only
+    reads headers and a query only pages in the clusters it scans:
+    - index.json: embedder, dimension and current generation
+    - centroids.<generation>.npy: nlist x dimension
+    - offsets.<generation>.npy: start of each cluster in vectors and ids, plus the end
+    - vectors.<generation>.npy: the main segment, grouped by cluster
+    - ids.<generation>.npy: the chunk id of each vector of the main segment
+    - delta.<generation>.f32, delta_ids.<generation>.i64: the delta segment, append only
+    - documents.sqlite: the chunks by id with their source, and the tombstones
+    """
+
+    def __init__(self, path: str, embedder: Embedder):
+        self.path = path
+        self.embedder = embedder
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._version = 0
+
+        self._connection = sqlite3.connect(os.path.join(path, "documents.sqlite"), check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            )
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS tombstones (id INTEGER PRIMARY KEY)")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        """)
+        self._connection.commit()
+
+        meta_path = os.path.join(path, "index.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["embedder"] != embedder.name:
+                raise ValueError(
+                    f"The index at {path} was built with the {meta['embedder']} embedder, not {embedder.name}"
+                )
+            generation = meta["generation"]
+        else:
+            generation = 0
+            self._write_segment(
+                generation,
+                np.zeros((1, embedder.dimension), dtype=np.float32),
+                np.zeros((0, embedder.dimension), dtype=np.float32),
+                np.zeros(0, dtype=np.int64),
+            )
+            self._write_meta(generation)
+
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        self._next_id = int(row[0]) if row else 0
+        self._dead = np.zeros(self._next_id, dtype=bool)
+        tombstones = [row[0] for row in self._connection.execute("SELECT id FROM tombstones")]
+        self._dead[tombstones] = True
+        self._open(generation)
+
+    def _file(self, name: str, generation: int) -> str:
+        base, extension = os.path.splitext(name)
+        return os.path.join(self.path, f"{base}.{generation}{extension}")
+
+    def _write_meta(self, generation: int) -> None:
+        meta_path = os.path.join(self.path, "index.json")
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"embedder": self.embedder.name, "dimension": self.embedder.dimension,
+                       "generation": generation}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def _write_segment(
+            self,
+            generation: int,
+            centroids: NDArray[np.float32],
+            vectors: NDArray[np.float32],
+            ids: NDArray[np.int64],
+    ) -> None:
+        lists = assign_lists(vectors, centroids)
+        order = np.argsort(lists, kind="stable")
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=len(centroids)), out=offsets[1:])
+        save_array(self._file("centroids.npy", generation), centroids)
+        save_array(self._file("offsets.npy", generation), offsets)
+        save_array(self._file("vectors.npy", generation), np.ascontiguousarray(vectors[order]))
+        save_array(self._file("ids.npy", generation), np.ascontiguousarray(ids[order]))
+        open(self._file("delta.f32", generation), "wb").close()
+        open(self._file("delta_ids.i64", generation), "wb").close()
+
+    def _open(self, generation: int) -> None:
+        self._generation = generation
+        self.centroids: NDArray[np.float32] = np.load(self._file("centroids.npy", generation))
+        self.offsets: NDArray[np.int64] = np.load(self._file("offsets.npy", generation))
+        self.vectors: NDArray[np.float32] = np.load(self._file("vectors.npy", generation), mmap_mode="r")
+        self.ids: NDArray[np.int64] = np.load(self._file("ids.npy", generation), mmap_mode="r")
+        self._open_delta()
+
+    def _open_delta(self) -> None:
+        """
+        A crash while appending can leave the two delta files with
+        different lengths, so only complete rows are read
+        """
+        vector_path = self._file("delta.f32", self._generation)
+        id_path = self._file("delta_ids.i64", self._generation)
+        count = min(os.path.getsize(vector_path) // (4 * self.embedder.dimension), os.path.getsize(id_path) // 8)
+        self.delta_vectors: NDArray[np.float32] = read_raw(
+            vector_path, np.dtype(np.float32), (count, self.embedder.dimension)
+        )
+        self.delta_ids: NDArray[np.int64] = read_raw(id_path, np.dtype(np.int64), (count,))
+
+    @property
+    def version(self) -> int:
+        """
+        Counts the upserts, deletes and compactions of this store,
+        so what is derived from its ids and rows can tell it is stale
+        """
+        with self._lock:
+            return self._version
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(self._connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0])
+
+    def checksums(self, source: str) -> List[str]:
+        """
+        Checksums of the chunks of a source, in order
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT checksum FROM chunks WHERE source = ? ORDER BY id", (source,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def sources(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT DISTINCT source FROM chunks")]
+
+    def upsert(self, documents: Dict[str, List[Document]], vectors: NDArray[np.float32]) -> None:
+        """
+        Replaces the chunks of each source with its documents. vectors has
+        the vectors of all the documents, in order.
+        The new ids are reserved before the vectors are appended, and the
+        chunks are only committed after, so a crash leaves at worst vectors
+        without chunks, which are never returned and dropped by compaction.
+        """
+        with self._lock:
+            sources = list(documents)
+            old_ids = [
+                row[0]
+                for source in sources
+                for row in self._connection.execute("SELECT id FROM chunks WHERE source = ?", (source,))
+            ]
+            first_id = self._next_id
+            self._next_id += len(vectors)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (str(self._next_id),)
+            )
+            self._connection.commit()
+
+            with open(self._file("delta.f32", self._generation), "ab") as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with open(self._file("delta_ids.i64", self._generation), "ab") as f:
+                f.write(np.arange(first_id, self._next_id, dtype=np.int64).tobytes())
+
+            self._connection.executemany("INSERT OR IGNORE INTO tombstones (id) VALUES (?)", ((i,) for i in old_ids))
+            self._connection.executemany("DELETE FROM chunks WHERE source = ?", ((source,) for source in sources))
+            self._connection.executemany(
+                "INSERT INTO chunks (id, source, checksum, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (first_id + i, source, text_checksum(document.page_content), document.page_content,
+                     json.dumps(document.metadata))
+                    for i, (source, document) in enumerate(
+                        (source, document) for source in sources for document in documents[source]
+                    )
+                ),
+            )
+            self._connection.commit()
+
+            dead = np.zeros(self._next_id, dtype=bool)
+            dead[:len(self._dead)] = self._dead
+            dead[old_ids] = True
+            self._dead = dead
+            self._open_delta()
+            self._version += 1
+
+    def delete(self, sources: List[str]) -> None:
+        """
+        Tombstones the chunks of sources
+        """
+        with self._lock:
+            old_ids = [
+                row[0]
+                for source in sources
+                for row in self._connection.execute("SELECT id FROM chunks WHERE source = ?", (source,))
+            ]
+            self._connection.executemany("INSERT OR IGNORE INTO tombstones (id) VALUES (?)", ((i,) for i in old_ids))
+            self._connection.executemany("DELETE FROM chunks WHERE source = ?", ((source,) for source in sources))
+            self._connection.commit()
+            self._dead[old_ids] = True
+            self._version += 1
+
+    def needs_compaction(self) -> bool:
+        with self._lock:
+            tombstones = int(self._connection.execute("SELECT COUNT(*) FROM tombstones").fetchone()[0])
+            return len(self.delta_ids) + tombstones > COMPACTION_RATIO * max(len(self.ids), 1)
+
+    def compact(self) -> None:
+        """
+        Writes a new main segment with the live vectors of the current
+        segments. The clusters are trained again when the number of vectors
+        has moved far from what they were trained for, otherwise the
+        vectors are assigned to the current centroids.
+        Upserts and queries go on while the segment is written; chunks
+        appended meanwhile are carried over to the delta of the new segment.
+        """
+        with self._lock:
+            generation = self._generation
+            centroids = self.centroids
+            vectors = [self.vectors, self.delta_vectors]
+            ids = [self.ids, self.delta_ids]
+            delta_count = len(self.delta_ids)
+            live_ids = np.fromiter(
+                (row[0] for row in self._connection.execute("SELECT id FROM chunks")), dtype=np.int64
+            )
+
+        all_ids = np.concatenate(ids)
+        keep = np.isin(all_ids, live_ids)
+        live_vectors = np.concatenate([np.asarray(part) for part in vectors])[keep]
+        count = len(live_vectors)
+        target = max(1, round(count ** 0.5))
+        if count > 0 and not target / 2 <= len(centroids) <= target * 2:
+            centroids = kmeans(live_vectors, target)
+        self._write_segment(generation + 1, centroids, live_vectors, all_ids[keep])
+        dropped = all_ids[~keep]
+
+        with self._lock:
+            appended = slice(delta_count, len(self.delta_ids))
+            with open(self._file("delta.f32", generation + 1), "ab") as f:
+                f.write(np.ascontiguousarray(self.delta_vectors[appended]).tobytes())
+            with open(self._file("delta_ids.i64", generation + 1), "ab") as f:
+                f.write(np.ascontiguousarray(self.delta_ids[appended]).tobytes())
+            self._write_meta(generation + 1)
+            self._connection.executemany(
+                "DELETE FROM tombstones WHERE id = ?", ((int(i),) for i in dropped)
+            )
+            self._connection.commit()
+            self._open(generation + 1)
+            self._version += 1
+
+        """
+        Queries that started before the switch keep their mappings
+        of the old files, which stay readable until they are closed
+        """
+        for name in ("centroids.npy", "offsets.npy", "vectors.npy", "ids.npy", "delta.f32", "delta_ids.i64"):
+            try:
+                os.remove(self._file(name, generation))
+            except OSError:
+                pass
+
+    def search(
+            self,
+            query: NDArray[np.float32],
+            k: int = 4,
+            nprobe: int = DEFAULT_NPROBE,
+            allowed: Optional[NDArray[np.bool_]] = None,
+    ) -> Tuple[NDArray[np.int64], NDArray[np.float32]]:
+        """
+        Returns the ids and scores of the k nearest live chunks to a query
+        vector, best first, scanning the nprobe closest clusters and the delta
+        """
+        return self.search_batch(query[np.newaxis], k, nprobe, allowed)[0]
+
+    def search_batch(
+            self,
+            queries: NDArray[np.float32],
+            k: int = 4,
+            nprobe: int = DEFAULT_NPROBE,
+            allowed: Optional[NDArray[np.bool_]] = None,
+    ) -> List[Tuple[NDArray[np.int64], NDArray[np.float32]]]:
+        """
+        Searches many query vectors at once. Each cluster probed by any of
+        the queries is read once and scored against all the queries that
+        probe it in a single matrix product, and so is the delta.
+        allowed, indexed by chunk id, limits the chunks that can be returned.
+        """
+        with self._lock:
+            centroids, offsets, vectors, ids = self.centroids, self.offsets, self.vectors, self.ids
+            delta_vectors, delta_ids, dead = self.delta_vectors, self.delta_ids, self._dead
+
+        count = len(queries)
+        nprobe = max(1, min(nprobe, len(centroids)))
+        if nprobe < len(centroids):
+            probes = np.argpartition(-(queries @ centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(len(centroids)), (count, len(centroids)))
+        clusters = probes.ravel()
+        members = np.repeat(np.arange(count), nprobe)
+        order = np.argsort(clusters, kind="stable")
+        clusters, members = clusters[order], members[order]
+        group_starts = np.flatnonzero(np.r_[True, clusters[1:] != clusters[:-1]])
+        group_ends = np.r_[group_starts[1:], len(clusters)]
+
+        score_parts: List[List[NDArray[np.float32]]] = [[] for _ in range(count)]
+        id_parts: List[List[NDArray[np.int64]]] = [[] for _ in range(count)]
+        for group_start, group_end in zip(group_starts, group_ends):
+            cluster = clusters[group_start]
+            start, end = offsets[cluster], offsets[cluster + 1]
+            if start == end:
+                continue
+            group = members[group_start:group_end]
+            block_scores = vectors[start:end] @ queries[group].T
+            block_ids = np.asarray(ids[start:end])
+            for column, query_index in enumerate(group):
+                score_parts[query_index].append(block_scores[:, column])
+                id_parts[query_index].append(block_ids)
+        if len(delta_ids):
+            delta_scores = delta_vectors @ queries.T
+            for query_index in range(count):
+                score_parts[query_index].append(delta_scores[:, query_index])
+                id_parts[query_index].append(np.asarray(delta_ids))
+
+        return [
+            best_hits(score_parts[query_index], id_parts[query_index], k, dead, allowed)
+            for query_index in range(count)
+        ]
+
+    def ids_with_source_prefix(self, prefix: str) -> NDArray[np.int64]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id FROM chunks WHERE source >= ? AND source < ?", (prefix, prefix + "\U0010ffff")
+            )
+            return np.fromiter((row[0] for row in rows), dtype=np.int64)
+
+    def rows(self, ids: NDArray[np.int64]) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+        """
+        Positions of the vectors of chunk ids in the main segment and the delta
+        """
+        with self._lock:
+            main_ids, delta_ids = np.asarray(self.ids), np.asarray(self.delta_ids)
+        return np.flatnonzero(np.isin(main_ids, ids)), np.flatnonzero(np.isin(delta_ids, ids))
+
+    def search_rows(
+            self,
+            queries: NDArray[np.float32],
+            rows: Tuple[NDArray[np.int64], NDArray[np.int64]],
+            k: int = 4,
+    ) -> List[Tuple[NDArray[np.int64], NDArray[np.float32]]]:
+        """
+        Exact search restricted to the vectors at rows, as returned by rows(),
+        for filters that leave too few chunks for the clusters to find them
+        """
+        with self._lock:
+            vectors, ids, delta_vectors, delta_ids, dead = (
+                self.vectors, self.ids, self.delta_vectors, self.delta_ids, self._dead
+            )
+        main_rows, delta_rows = rows
+        candidates = np.concatenate([np.asarray(ids[main_rows]), np.asarray(delta_ids[delta_rows])])
+        scores = np.concatenate([vectors[main_rows], delta_vectors[delta_rows]]) @ queries.T
+        return [best_hits([scores[:, query_index]], [candidates], k, dead, None) for query_index in range(len(queries))]
+
+    def get_documents(self, ids: List[int]) -> Dict[int, Document]:
+        rows = []
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows += self._connection.execute(
+                    f"SELECT id, text, metadata FROM chunks WHERE id IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+        return {row[0]: Document(page_content=row[1], metadata=json.loads(row[2])) for row in rows}
+
+    def similarity_search_with_score(
+            self,
+            query: str,
+            k: int = 4,
+            nprobe: int = DEFAULT_NPROBE,
+    ) -> List[Tuple[Document, float]]:
+        ids, scores = self.search(self.embedder.embed_query(query), k, nprobe)
+        documents = self.get_documents([int(i) for i in ids])
+        return [(documents[int(i)], float(score)) for i, score in zip(ids, scores) if int(i) in documents]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
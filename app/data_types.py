@@ -1,7 +1,14 @@
-from dataclasses import dataclass
-from typing import List, TypeAlias, Callable, Optional
+from dataclasses import dataclass, field
+from typing import List, TypeAlias, Callable, Optional, Dict
 
 from langchain.llms import OpenAIChat
+from langchain.schema import Document
+
+
+@dataclass
+class RateLimits:
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
 
 
 @dataclass
@@ -18,6 +25,27 @@ class AutodocRepoConfig:
     content_type: str
     target_audience: str
     link_hosted: bool
+    max_concurrent_calls: int = 25
+    concurrency: int = 16
+    concurrency_backend: str = "thread"
+    max_file_size: Optional[int] = 1024 * 1024
+    git_incremental: bool = False
+    scan_workers: int = 0
+    model_strategy: str = "cheapest"
+    cost_budget: Optional[float] = None
+    chunk_tokens: int = 2000
+    folder_tokens: int = 6000
+    cache_dir: Optional[str] = None
+    cache_max_bytes: int = 512 * 1024 * 1024
+    rate_limits: Dict[str, RateLimits] = field(default_factory=dict)
+    embedder: str = "text-embedding-ada-002"
+    export_json: bool = False
+    max_attempts: int = 4
+    resume: bool = False
+    prometheus_report: bool = False
+    shards: int = 1
+    shard: Optional[int] = None
+    merge_only: bool = False
 
 
 @dataclass
@@ -30,6 +58,15 @@ class FileSummary:
     checksum: str
 
 
+@dataclass
+class FileRecord:
+    file_path: str
+    size: int
+    mtime_ns: int
+    text: str
+    checksum: str
+
+
 @dataclass
 class ProcessFileParams:
     file_name: str
@@ -67,6 +104,8 @@ class ProcessFolderParams:
     target_audience: str
     link_hosted: bool
     should_ignore: Callable[[str], bool]
+    folder_names: List[str] = field(default_factory=list)
+    file_names: List[str] = field(default_factory=list)
 
 
 ProcessFolder: TypeAlias = Callable[[ProcessFolderParams], None]
@@ -84,6 +123,7 @@ class TraverseFileSystemParams:
     content_type: str
     target_audience: str
     link_hosted: bool
+    scan_workers: int = 0
 
 
 @dataclass
@@ -98,3 +138,11 @@ class LLMModelDetails:
     succeeded: int
     failed: int
     total: int
+    calls: int = 0
+
+
+@dataclass
+class SearchResult:
+    id: int
+    score: float
+    document: Document
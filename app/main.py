@@ -1,9 +1,49 @@
+import argparse
+
+from .cli.commands.estimate.estimate import estimate
 from .cli.commands.index.index import index
+from .cli.commands.query.query import query
 from .data_types import AutodocRepoConfig
 
 
 def main() -> None:
-    index(AutodocRepoConfig(
+    parser = argparse.ArgumentParser(prog="autodoc")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="index",
+        choices=["index", "estimate", "query"],
+        help="index the repository, estimate the tokens, cost and time indexing it would take, "
+             "or search the index",
+    )
+    parser.add_argument("questions", nargs="*", help="questions to search for, or one per line of stdin")
+    parser.add_argument("-k", type=int, default=4, help="results for each question")
+    parser.add_argument("--prefix", help="only search files whose path in the repository starts with this prefix")
+    parser.add_argument("--rerank", action="store_true", help="rerank the results by the words of the question")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last index run, only redoing the files and folders it did not finish",
+    )
+    parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        help="also write the run report of index in the Prometheus text format",
+    )
+    parser.add_argument("--shards", type=int, default=1, help="split the files of index into this many shards")
+    parser.add_argument(
+        "--shard",
+        type=int,
+        help="only summarize the files of this shard, from 0, for running the shards on several machines",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="merge the shards run with --shard and summarize the folders, without running any shard here",
+    )
+    args = parser.parse_args()
+
+    config = AutodocRepoConfig(
         name="autodoc-python",
         repository_url="https://github.com/dplusic/autodoc-python",
         root=".",
@@ -30,7 +70,19 @@ def main() -> None:
         content_type="code",
         target_audience="smart developer",
         link_hosted=True,
-    ))
+        resume=args.resume,
+        prometheus_report=args.prometheus,
+        shards=args.shards,
+        shard=args.shard,
+        merge_only=args.merge,
+    )
+
+    if args.command == "estimate":
+        estimate(config)
+    elif args.command == "query":
+        query(config, args.questions, args.k, args.prefix, args.rerank)
+    else:
+        index(config)
 
 
 if __name__ == '__main__':